@@ -5,11 +5,14 @@ Created on Fri Jan 20 18:51:07 2017
 @author: Nick Areias, Jeffrey Paquette
 """
 
+import time
 import numpy
-import random
-import scipy
+import scipy.spatial
 
-import filters
+import instrument
+import kernels
+import render
+import snapshots
 
 class SOMNeuron():
     """A single neuron in a SOM"""
@@ -31,12 +34,87 @@ class SOMNeuron():
         numpy.round(self.w)
         
         
+class NeuronView(SOMNeuron):
+    """A SOMNeuron backed by one row of the arrays of an UnchainedSOM"""
+    
+    def __init__(self, som, index):
+        """Instantiate a view of a neuron
+        
+        Keyword arguments:
+        som -- the UnchainedSOM owning the arrays
+        index -- the row of this neuron
+        """
+        self.som = som
+        self.index = index
+        self.w = som.weights[index]
+        
+    @property
+    def wins(self):
+        return self.som.wins[self.index]
+    
+    @wins.setter
+    def wins(self, value):
+        self.som.set_wins(self.index, value)
+        
+    @property
+    def neighborhood(self):
+        return self.som.neighborhood[self.index]
+    
+    @neighborhood.setter
+    def neighborhood(self, value):
+        self.som.neighborhood[self.index] = value
+        
+    def round_weights(self):
+        """round weight values"""
+        numpy.round(self.w, out=self.w)
+        
+        
+def crop_bands(weights, height, percentiles=(10, 90)):
+    """Returns the top and bottom crop bounds of a plate estimated from the
+       neuron y positions, as a dict of (top, bottom) pairs:
+       
+       outliers -- the highest and lowest neuron
+       averages -- the average neuron above and below the middle row, or 
+                   the outlier when a half has no neurons
+       percentiles -- the given low and high percentiles, which ignore a 
+                      few stray neurons
+       
+       Without neurons every estimate is the whole image.
+    
+    Keyword arguments:
+    weights -- (N, 2) array of neuron x, y positions
+    height -- height of the image
+    percentiles -- (low, high) percentiles for the robust bounds
+    """
+    ys = numpy.asarray(weights, dtype=float).reshape(-1, 2)[:, 1]
+    if (len(ys) == 0):
+        whole = (0.0, float(height))
+        return {'outliers': whole, 'averages': whole, 'percentiles': whole}
+    
+    top = ys.min()
+    bottom = ys.max()
+    mid = height / 2
+    above = ys < mid
+    below = ys > mid
+    low, high = numpy.percentile(ys, percentiles)
+    return {
+        'outliers': (top, bottom),
+        'averages': (ys[above].mean() if (above.any()) else top, 
+                     ys[below].mean() if (below.any()) else bottom),
+        'percentiles': (low, high),
+    }
+    
 class UnchainedSOM():
     """Handles running, managing, and monitoring an unchained SOM for 2D image 
        analysis
     """
     #image = []              # blur-> grayscale -> canny edge detection
-    #neurons = []            # list of neurons in map
+    #weights = []            # (N, 2) array of neuron x, y positions
+    #win_count = []          # (N,) wins of each neuron in cycle win_cycle
+    #win_cycle = []          # (N,) competition cycle win_count belongs to
+    #cycle = 1               # current competition cycle
+    #outstanding = 0         # neurons without a win in the current cycle
+    #neighborhood = []       # (N,) neighborhood scalar of each neuron
     #win_limit = 1           # number of wins allowed per competition cycle
     #nu_not = 0.01           # initial learning rate
     #tau_nu = 10000          # learning decay rate
@@ -44,10 +122,35 @@ class UnchainedSOM():
     #snapshot = 0            # epoch interval at which to show the current state
     #contrast = 0            # constrast of snapshot image
     #neuron_size = 1         # the size of each displayed neuron during a snapshot
+    #batch_size = 1          # number of samples drawn per training step
+    #tolerance = 0           # displacement per window to stop at (0 = never)
+    #window = 100            # epochs between convergence checks
+    #first_epoch = 1         # epoch start begins at, later after a warm start
+    #stop_epoch = 0          # last epoch trained by start
+    #displacement = None     # largest neuron movement in the last window
+    tree_size = 64          # neuron count from which batches search a KD-tree
+    #foreground = []         # (M, 2) x, y positions of the pixels to sample
+    #rng = None              # numpy.random.Generator used for sampling
     image_count = 0         # index of snapshot image saved
     path = 'sompics/pic_'   # the path of saving the image
     
-    def __init__(self, image, learnrate, ldecay, winlimit, epochs, snapshot, contrast, neuron_size):
+    def __init__(self, image, learnrate, ldecay, winlimit, epochs, snapshot, contrast, neuron_size, 
+                 capture=None, batch_size=1, rng=None, tolerance=0, window=100, metrics=None,
+                 backend=None):
+        """UnchainedSOM init
+        
+        Keyword arguments:
+        capture -- snapshots.Capture that receives a frame every snapshot
+                   epochs, snapshots are off when None
+        batch_size -- number of samples trained per step, see epoch_batch
+        rng -- numpy.random.Generator or seed for reproducible runs
+        tolerance -- stop early once no neuron moved further than this over
+                     a window of epochs (0 trains all epochs)
+        window -- number of epochs between convergence checks
+        metrics -- instrument.Metrics that receives counters and timings
+        backend -- 'numba' to run single sample epochs with the compiled 
+                   kernel, 'python' for numpy, None for kernels.BACKEND
+        """
         self.image = image
         self.nu_not = learnrate
         self.tau_nu = ldecay
@@ -56,17 +159,140 @@ class UnchainedSOM():
         self.snapshot = snapshot
         self.contrast = contrast
         self.neuron_size = neuron_size
+        self.capture = capture
+        self.batch_size = batch_size
+        self.rng = numpy.random.default_rng(rng)
+        self.tolerance = tolerance
+        self.window = window
+        self.stop_epoch = 0
+        self.first_epoch = 1
+        self.displacement = None
+        self.metrics = metrics if (metrics is not None) else instrument.NULL
+        self.background = None      # darkened image the neurons are drawn on
+        self.backend = kernels.choose_backend(backend)
+        self.set_weights(numpy.zeros((0, 2)))
+        self.index_foreground()
         return    
     
+    def index_foreground(self):
+        """Build the pool of non background pixels samples are drawn from, 
+           leaving out a 5 pixel border.
+        """
+        image = numpy.asarray(self.image)
+        ys, xs = numpy.nonzero(image[5:len(image) - 4, 5:len(image[0]) - 4])
+        self.foreground = numpy.stack([xs + 5, ys + 5], axis=1)
+        return
+    
+    def set_weights(self, weights):
+        """Replace every neuron of the map, resetting win counts and 
+           neighborhoods.
+        
+        Keyword arguments:
+        weights -- an (N, 2) array of neuron x, y positions
+        """
+        self.weights = numpy.array(weights, dtype=float).reshape(-1, 2)
+        self.win_count = numpy.zeros(len(self.weights), dtype=int)
+        self.win_cycle = numpy.zeros(len(self.weights), dtype=int)
+        self.cycle = 1
+        self.outstanding = len(self.weights)
+        self.neighborhood = numpy.ones(len(self.weights))
+        self.neuron_views = None
+        return
+    
+    @property
+    def wins(self):
+        """(N,) wins of each neuron in the current competition cycle"""
+        return numpy.where(self.win_cycle == self.cycle, self.win_count, 0)
+    
+    def set_wins(self, index, value):
+        """Set the win count of one neuron in the current competition cycle
+        
+        Keyword arguments:
+        index -- index of the neuron
+        value -- its new win count
+        """
+        won = self.win_cycle[index] == self.cycle
+        if (value == 0):
+            # no wins is no stamp, so the next win counts it as fresh
+            self.win_count[index] = 0
+            self.win_cycle[index] = 0
+            if (won):
+                self.outstanding += 1
+            return
+        self.win_count[index] = value
+        self.win_cycle[index] = self.cycle
+        if (not won):
+            self.outstanding -= 1
+            self.end_cycle()
+        return
+    
+    def add_wins(self, winners, counts):
+        """Count wins for some neurons, starting a new competition cycle if 
+           every neuron has won at least once. Only touches the winners.
+        
+        Keyword arguments:
+        winners -- array of distinct neuron indices
+        counts -- number of wins to add for each of them
+        """
+        fresh = self.win_cycle[winners] != self.cycle
+        self.win_count[winners[fresh]] = 0
+        self.win_cycle[winners] = self.cycle
+        self.win_count[winners] += counts
+        self.outstanding -= numpy.count_nonzero(fresh)
+        self.end_cycle()
+        return
+    
+    def end_cycle(self):
+        """Reset the competition cycle in constant time, by moving to a new
+           cycle number, once no neuron is left without a win
+        """
+        if (self.outstanding == 0):
+            self.cycle += 1
+            self.outstanding = len(self.weights)
+            self.metrics.count('som.cycle_resets')
+        return
+    
+    def eligible(self):
+        """Returns a mask of the neurons still allowed to win this cycle"""
+        return (self.win_cycle != self.cycle) | (self.win_count < self.win_limit)
+    
+    @property
+    def neurons(self):
+        """List of SOMNeuron views over the weight arrays, built on first use"""
+        if (self.neuron_views is None):
+            self.neuron_views = [NeuronView(self, i) for i in range(len(self.weights))]
+        return self.neuron_views
+    
+    @neurons.setter
+    def neurons(self, neurons):
+        self.set_weights([n.w for n in neurons])
+    
     def init_neurons_random(self, number):
-        """Initialize a specified number of neurons with random weights.
+        """Initialize a specified number of neurons on random non background 
+           pixels.
         
         Keyword arguments:
         number -- the number of neurons to generate
         """
-        self.neurons = [SOMNeuron([random.randint(0,len(self.image[0])), random.randint(0, len(self.image))]) for q in range(number)]
+        xs, ys = self.sample_pixels(number)
+        self.set_weights(numpy.stack([xs, ys], axis=1))
         return
                         
+    def warm_start(self, weights, epochs):
+        """Start from already trained weights, for example those of an 
+           earlier plate of the same camera, and only train the last epochs 
+           of the schedule, where the learning rate and neighborhoods are 
+           small enough to fine tune instead of reshaping the map.
+        
+        Keyword arguments:
+        weights -- an (N, 2) array of trained neuron x, y positions
+        epochs -- number of epochs to fine tune for
+        """
+        self.set_weights(weights)
+        self.first_epoch = max(1, self.epochs - epochs)
+        self.metrics.count('som.warm_starts')
+        return
+    
     def init_neurons_grid(self, xgrid, ygrid):
         """Initialize a grid of neurons with evenly distributed weight values
         
@@ -77,157 +303,274 @@ class UnchainedSOM():
         yoffset = len(self.image) / (ygrid+1)
         xoffset = len(self.image[0]) / (xgrid+1)
     
-        for i in range(xgrid):
-            for j in range(ygrid):
-                xi = (i+1) * numpy.floor(xoffset)
-                yj = (j+1) * numpy.floor(yoffset)
-                self.neurons.append(SOMNeuron([xi,yj]))
+        xi = numpy.arange(1, xgrid + 1) * numpy.floor(xoffset)
+        yj = numpy.arange(1, ygrid + 1) * numpy.floor(yoffset)
+        grid = numpy.stack(numpy.meshgrid(xi, yj, indexing='ij'), axis=-1).reshape(-1, 2)
+        self.set_weights(numpy.concatenate([self.weights, grid]))
         return
                 
     def start(self):
-        """Start the SOM learning process"""
-        # show initial image
-        highlighted_image = self.show_highlighted_image()
+        """Start the SOM learning process. Runs from first_epoch (1 unless 
+           warm started) to at most epochs, and stops early when the 
+           tolerance is reached. The last epoch trained is kept in 
+           stop_epoch and the last measured displacement in displacement.
+        """
+        take_snapshot = self.capture is not None
+        if (take_snapshot):
+            # show initial image
+            self.plate = self.capture.begin()
+            highlighted_image = self.show_highlighted_image()
         
-        # iterate through all epochs
-        for t in range(1, self.epochs):
-            self.epoch(t)
+        # weights at the start of the current convergence window
+        mark = self.weights.copy()
+        check = self.first_epoch + self.window
+        self.displacement = None
+        
+        # iterate through all epochs, batch_size epochs at a time
+        start = time.perf_counter()
+        steps = 0
+        t = self.first_epoch
+        while (t < self.epochs):
+            count = min(self.batch_size, self.epochs - t)
+            if (count == 1):
+                self.epoch(t)
+            else:
+                self.epoch_batch(t, count)
+            t += count
+            steps += 1
         
             #check a snapshot of the image and neurons every few iterations
-            if(t % self.snapshot == 0):
+            if(take_snapshot and (t - 1) // self.snapshot > (t - 1 - count) // self.snapshot):
                 highlighted_image = self.show_highlighted_image()
+                
+            # stop once the neurons settle
+            if (self.tolerance and t >= check):
+                moved = numpy.sqrt(numpy.square(self.weights - mark).sum(axis=1))
+                self.displacement = moved.max() if (len(moved) > 0) else 0.0
+                if (self.displacement < self.tolerance):
+                    self.metrics.count('som.early_stops')
+                    break
+                mark = self.weights.copy()
+                check = t + self.window
+        self.stop_epoch = t - 1
+        if (self.metrics.enabled):
+            self.metrics.add_time('som.train', time.perf_counter() - start)
+            self.metrics.count('som.epochs', t - self.first_epoch)
+            self.metrics.count('som.steps', steps)
            
         highlighted_image = self.highlight_neurons()
+        if (take_snapshot):
+            self.capture.end(self.plate)
+        self.metrics.report('som')
         
         return highlighted_image
     
+    def crop_bands(self, percentiles=(10, 90)):
+        """Returns every crop estimate of the current neurons, see crop_bands
+        
+        Keyword arguments:
+        percentiles -- (low, high) percentiles for the robust bounds
+        """
+        return crop_bands(self.weights, len(self.image), percentiles)
+    
+    def crop_rows(self, estimate='percentiles', margin=0, percentiles=(10, 90)):
+        """Returns a (first, last) pair of whole rows to pass to a Tracer as
+           its region of interest
+        
+        Keyword arguments:
+        estimate -- 'outliers', 'averages' or 'percentiles', see crop_bands
+        margin -- rows added above and below the estimate
+        percentiles -- (low, high) percentiles for the robust bounds
+        """
+        top, bottom = self.crop_bands(percentiles)[estimate]
+        first = max(int(numpy.floor(top)) - margin, 0)
+        last = min(int(numpy.ceil(bottom)) + margin, len(self.image) - 1)
+        return first, last
+    
     def crop_image_at_vertical_outliers(self):
         """Returns cropped image coordinates at the highest and lowest neuron 
            positions ([top, bottom]).
         """
-        top_neuron = None
-        bottom_neuron = None
-        
-        # cycle through neurons to find highest and lowest
-        for n in self.neurons:
-            if (top_neuron is None):
-                top_neuron = n
-            if (bottom_neuron is None):
-                bottom_neuron = n
-            if (n.w[1] < top_neuron.w[1]):
-                top_neuron = n
-            if (n.w[1] > bottom_neuron.w[1]):
-                bottom_neuron = n
-                
-        # crop image at top and bottom neuron positions
-        cropped_image = [top_neuron.w[1], bottom_neuron.w[1]]
-
-        # cropped_image = self.image[top_neuron.w[1]:bottom_neuron.w[1]][0:len(self.image[0])]
-
-        return cropped_image
+        return list(self.crop_bands()['outliers'])
         
     def crop_image_at_vertical_averages(self):
         """Returns cropped image coordinates at the average y position of the 
-           top and bottom half of neurons ([top, bottom]).
+           top and bottom half of neurons ([top, bottom]). A half without 
+           neurons falls back to the highest or lowest neuron.
         """
-        top_neurons = []
-        bottom_neurons = []
-        
-        mid = len(self.image) / 2
-        # cycle through neurons and split into two lists
-        for n in self.neurons:
-            if (n.w[1] < mid):
-                top_neurons.append(n)
-            elif (n.w[1] > mid):
-                bottom_neurons.append(n)
-                
-        # cycle through top neurons to find average top position
-        top = 0
-        for n in top_neurons:
-            top += n.w[1]
+        return list(self.crop_bands()['averages'])
         
-        top = top / len(top_neurons)
+    def epoch(self, time):
+        """One cycle of the learning process
         
-        # cycle through bottom neurons to find average top position
-        bottom = 0
-        for n in bottom_neurons:
-            bottom += n.w[1]
+        Keyword arguments:
+        time -- current epoch count
+        """
+        if (self.backend == 'numba'):
+            self.compiled_epoch(time)
+            return
+        if (self.metrics.enabled):
+            self.timed_epoch(time)
+            return
         
-        bottom = bottom / len(bottom_neurons)
+        #select random non background pixel from the input
+        xs, ys = self.sample_pixels(1)
+        x = xs[0]
+        y = ys[0]
         
-        # crop image at top and bottom average positions
-        # cropped_image = self.image[top:bottom][0:len(self.image[0])]
-        cropped_image = [top, bottom]
-
-        return cropped_image
+        # determine winner
+        winner = self.find_winner(x, y)
         
-    def epoch(self, time):
-        """One cycle of the learning process
+        # calculate neighborhood
+        self.calculate_neighborhood(x, y, winner, time)
+        
+        # adjust weights
+        self.adjust_weights(x, y, time)
+        return
+        
+    def timed_epoch(self, time):
+        """epoch with each of its phases timed into the metrics
         
         Keyword arguments:
         time -- current epoch count
         """
-        # keep trying random data points until a valid data point is found
-        done = False
-        while (done == False):
-    
-            #select random pixel from the input
-            x = random.randint(5,(len(self.image[0]) - 5))
-            y = random.randint(5,(len(self.image) - 5))
-            
-            # pixel is valid only if it is not background
-            if(self.image[y][x] != 0):
-                
-                # valid pixel was picked
-                done = True
-                
-                # determine winner
-                winner = self.find_winner(x, y)
-                
-                # calculate neighborhood
-                self.calculate_neighborhood(x, y, winner, time)
-                
-                # adjust weights
-                self.adjust_weights(x, y, time)
+        with self.metrics.timer('som.sample'):
+            xs, ys = self.sample_pixels(1)
+            x = xs[0]
+            y = ys[0]
+        with self.metrics.timer('som.find_winner'):
+            winner = self.find_winner(x, y)
+        with self.metrics.timer('som.neighborhood'):
+            self.calculate_neighborhood(x, y, winner, time)
+        with self.metrics.timer('som.adjust_weights'):
+            self.adjust_weights(x, y, time)
         return
         
+    def compiled_epoch(self, time):
+        """epoch with winner, neighborhood and weights computed by the 
+           compiled kernel, see kernels.som_epoch
+        
+        Keyword arguments:
+        time -- current epoch count
+        """
+        with self.metrics.timer('som.sample'):
+            xs, ys = self.sample_pixels(1)
+        with self.metrics.timer('som.kernel'):
+            learning_rate = self.nu_not / numpy.exp(time/self.tau_nu)
+            winner = kernels.som_epoch(self.weights, self.neighborhood, self.win_count, 
+                                       self.win_cycle, self.cycle, self.win_limit, 
+                                       xs[0], ys[0], time, learning_rate)
+        self.count_win(winner)
+        return
+        
+    def epoch_batch(self, time, count):
+        """Train on count samples at once, standing in for epochs time to 
+           time+count-1.
+           
+           Winners of all samples are found from one distance matrix against 
+           the weights and win counts at the start of the batch, so a neuron
+           may win more than win_limit samples of one batch, and the 
+           competition cycle is reset at most once per batch. The weight 
+           updates of every sample are summed and applied together, capped 
+           so that no neuron moves past the weighted mean of its samples.
+        
+        Keyword arguments:
+        time -- epoch count of the first sample
+        count -- number of samples
+        """
+        with self.metrics.timer('som.sample'):
+            xs, ys = self.sample_pixels(count)
+            times = numpy.arange(time, time + count)
+        
+        # determine winners
+        with self.metrics.timer('som.find_winner'):
+            winners = self.find_winners(xs, ys)
+            distinct, counts = numpy.unique(winners, return_counts=True)
+            self.add_wins(distinct, counts)
+        
+        # neighborhood of every neuron for every sample, scaled by the 
+        # learning rate of its epoch
+        with self.metrics.timer('som.neighborhood'):
+            neighborhood = self.neighborhoods(xs, ys, winners, times)
+            learning_rate = self.nu_not / numpy.exp(times/self.tau_nu)
+            step = learning_rate[:, None] * neighborhood
+        
+        # adjust weights by the summed pull of every sample, a neuron pulled
+        # by a total of more than 1 moves to the weighted mean of its samples
+        # instead of overshooting it
+        with self.metrics.timer('som.adjust_weights'):
+            pull = step.T @ numpy.stack([xs, ys], axis=1)
+            total = step.sum(axis=0)
+            with numpy.errstate(divide='ignore'):
+                scale = numpy.where(total > 1, 1 / total, 1)
+            self.weights += scale[:, None] * (pull - total[:, None] * self.weights)
+            self.neighborhood = neighborhood[-1]
+        return
+    
+    def sample_pixels(self, count):
+        """Returns x and y arrays of count random non background pixels
+        
+        Keyword arguments:
+        count -- number of pixels
+        """
+        if (len(self.foreground) == 0):
+            raise ValueError('image has no non background pixels to sample')
+        picks = self.foreground[self.rng.integers(len(self.foreground), size=count)]
+        return picks[:, 0].astype(float), picks[:, 1].astype(float)
+        
+    def find_winners(self, xs, ys):
+        """Returns the index of the closest eligible neuron for each sample.
+           Large maps are searched with a KD-tree over the eligible neurons,
+           small ones with a distance matrix.
+        
+        Keyword arguments:
+        xs -- x locations of the samples
+        ys -- y locations of the samples
+        """
+        eligible = numpy.flatnonzero(self.eligible())
+        if (len(eligible) < self.tree_size):
+            distance = (numpy.square(xs[:, None] - self.weights[eligible, 0]) + 
+                        numpy.square(ys[:, None] - self.weights[eligible, 1]))
+            return eligible[numpy.argmin(distance, axis=1)]
+        
+        # weights move every step, so the tree is built for this batch only
+        tree = scipy.spatial.cKDTree(self.weights[eligible])
+        nearest = tree.query(numpy.stack([xs, ys], axis=1))[1]
+        return eligible[nearest]
+        
     def find_winner(self, x, y):
-        """Find winner (closest neuron to the current pixel)
+        """Find winner (closest neuron to the current pixel) and return its 
+           index
         
         Keyword arguments:
         x -- x location of selected sample input
         y -- y location of selected sample input
         """
-        #set min_distance to be max distance
-        min_distance = numpy.sqrt(numpy.exp(len(self.image)) + numpy.exp(len(self.image[0])))
-        temp_dist = 0
-        
-        for n in self.neurons:
-            if(n.wins < self.win_limit):
-                temp_dist += numpy.square(x - n.w[0])
-                temp_dist += numpy.square(y - n.w[1])
-                temp_dist = numpy.sqrt(temp_dist)
-                
-                if(temp_dist < min_distance):
-                    winner = n
-                    min_distance = temp_dist
-                        
-            temp_dist = 0
-         
+        # squared distance of every neuron still allowed to win
+        distance = numpy.square(x - self.weights[:, 0]) + numpy.square(y - self.weights[:, 1])
+        distance[~self.eligible()] = numpy.inf
+        winner = int(numpy.argmin(distance))
+        self.count_win(winner)
+        return winner
+    
+    def count_win(self, winner):
+        """Count one win for a neuron, starting a new competition cycle if 
+           every neuron has won at least once
+        
+        Keyword arguments:
+        winner -- index of the winning neuron
+        """
         # increment win count
-        winner.wins += 1
+        if (self.win_cycle[winner] != self.cycle):
+            self.win_cycle[winner] = self.cycle
+            self.win_count[winner] = 1
+            self.outstanding -= 1
+        else:
+            self.win_count[winner] += 1
         
         # reset competition cycle if every neuron has won at least once
-        reset = 1
-        for n in self.neurons:
-            if (n.wins == 0):
-                reset = 0
-                
-        if (reset == 1):
-            for n in self.neurons:
-                n.wins = 0
-                
-        return winner
+        self.end_cycle()
+        return
     
     def calculate_neighborhood(self, x, y, winner, time):
         """Calculate the neighborhood value of each neuron.
@@ -235,45 +578,55 @@ class UnchainedSOM():
         Keyword arguments:
         x -- x location of selected sample input
         y -- y location of selected sample input
-        winner -- winning neuron
+        winner -- index of the winning neuron
         time -- current epoch
         """
-        for n in self.neurons:
-            #excite distance is lateral distance between winning neuron and current neuron.
-            #winner coords
-            w_x = winner.w[0]
-            w_y = winner.w[1]
-            #current neuron coords
-            c_x = n.w[0]
-            c_y = n.w[1]
-            
-            if(w_x != c_x or w_y != c_y):
-                
-                #distance between winner and current neuron
-                d1 = numpy.sqrt(numpy.square(w_x - c_x) + numpy.square(w_y - c_y))
-                
-                #distance between winner and selected point
-                d2 = numpy.sqrt(numpy.square(w_x - x) + numpy.square(w_y - y))
-                
-                #distance between current neuron and selected point
-                d3 = numpy.sqrt(numpy.square(c_x - x) + numpy.square(c_y - y))
-                
-                if(d1 == 0 or d2 == 0):
-                    n.neighborhood = 0
-                else:
-                    value = (numpy.square(d1) + numpy.square(d2) - numpy.square(d3)) / (2*d1*d2)
-                    
-                    #angle next to winner in the triangle between winner, current neuron, and selected point
-                    theta = numpy.arccos(numpy.clip(value,-1,1))
-                    
-                    #lateral distance between winner and current neuron
-                    lateral_distance = d1 * numpy.cos(theta)
-                    
-                    # shrink the neighborhood based on lateral distance and time
-                    n.neighborhood = 1/(lateral_distance * time)
-            else:
-                n.neighborhood = 1
+        self.neighborhood = self.neighborhoods(numpy.array([x]), numpy.array([y]), 
+                                               numpy.array([winner]), numpy.array([time]))[0]
         return
+    
+    def neighborhoods(self, xs, ys, winners, times):
+        """Returns a (samples, neurons) array with the neighborhood value of
+           each neuron for each sample.
+        
+        Keyword arguments:
+        xs -- x locations of the samples
+        ys -- y locations of the samples
+        winners -- index of the winning neuron of each sample
+        times -- epoch of each sample
+        """
+        #excite distance is lateral distance between winning neuron and current neuron.
+        w_x = self.weights[winners, 0][:, None]
+        w_y = self.weights[winners, 1][:, None]
+        c_x = self.weights[:, 0]
+        c_y = self.weights[:, 1]
+        x = xs[:, None]
+        y = ys[:, None]
+        
+        #distance between winner and each neuron
+        d1 = numpy.sqrt(numpy.square(w_x - c_x) + numpy.square(w_y - c_y))
+        
+        #distance between winner and selected point
+        d2 = numpy.sqrt(numpy.square(w_x - x) + numpy.square(w_y - y))
+        
+        #distance between each neuron and selected point
+        d3 = numpy.sqrt(numpy.square(c_x - x) + numpy.square(c_y - y))
+        
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            value = (numpy.square(d1) + numpy.square(d2) - numpy.square(d3)) / (2*d1*d2)
+            
+            #angle next to winner in the triangle between winner, neuron, and selected point
+            theta = numpy.arccos(numpy.clip(value,-1,1))
+            
+            #lateral distance between winner and each neuron
+            lateral_distance = d1 * numpy.cos(theta)
+            
+            # shrink the neighborhood based on lateral distance and time
+            neighborhood = 1/(lateral_distance * times[:, None])
+            
+        neighborhood[(d1 == 0) | (d2 == 0)] = 0
+        neighborhood[(w_x == c_x) & (w_y == c_y)] = 1
+        return neighborhood
         
     def adjust_weights(self, x, y, time):
         """Adjust weights of all neurons based on learning rate, neighborhood,
@@ -285,61 +638,46 @@ class UnchainedSOM():
         time -- current epoch
         """
         learning_rate = self.nu_not / numpy.exp(time/self.tau_nu)
-
-        for n in self.neurons:
-                
-                dx = learning_rate * n.neighborhood * (x - n.w[0])
-                dy = learning_rate * n.neighborhood * (y - n.w[1])
-                
-                n.w[0] += dx
-                n.w[1] += dy
+        
+        step = (learning_rate * self.neighborhood)[:, None]
+        self.weights += step * (numpy.array([x, y]) - self.weights)
         return
 
     def round_neurons(self):
         """Round the weight values of each neuron"""
-        for n in self.neurons:
-            n.round_weights()
+        numpy.round(self.weights, out=self.weights)
         return
     
     def trim_neurons_on_black(self):
         """Remove all neurons on black pixels."""
-        remove_list = []
-        for n in self.neurons:
-            if (self.image[n.w[1]][n.w[0]] == 0):
-                remove_list.append(n)
-        
-        for n in remove_list:
-            self.neurons.remove(n)
-            
+        position = numpy.rint(self.weights).astype(int)
+        keep = numpy.asarray(self.image)[position[:, 1], position[:, 0]] != 0
+        self.set_weights(self.weights[keep])
         return
         
     def show_highlighted_image(self):
-        """Show the image, highlighting the neurons by a specified size.
-        
-        Keyword arguments:
-        size -- the size in pixels of each neuron
+        """Show the image, highlighting the neurons by neuron_size. The frame
+           goes to the capture, or straight to the path without one.
         """
+        start = time.perf_counter()
         highlighted_image = self.highlight_neurons()
         # filters.draw(highlighted_image)
-        scipy.misc.imsave(self.path + str(self.image_count) + '.jpg', highlighted_image)
+        if (self.capture is not None):
+            self.capture.add(self.plate, highlighted_image)
+        else:
+            snapshots.write_frames(self.path + str(self.image_count), [highlighted_image], 'npz')
         self.image_count += 1
+        self.metrics.add_time('som.snapshot', time.perf_counter() - start)
         return highlighted_image
     
     def highlight_neurons(self):
         """Highlight all neuron locations by making pixels in a neuron_size 
-           radius the max intensity.
+           radius the max intensity. The neurons are drawn at their rounded 
+           positions, their weights are left as they are.
         """
         #highlight neurons to show where they are
-        intensity = numpy.max(self.image) * self.contrast
-    
-        highlighted_image = filters.darken(self.image, self.contrast)
-        
-        self.round_neurons()
-        for n in self.neurons:
-            #highlight a 3x3 around the neuron
-            for p in range(self.neuron_size):
-                for q in range(self.neuron_size):
-                    if(n.w[0] - 1 + p >= 0 and n.w[0] - 1 + p < len(highlighted_image[0]) and n.w[1] - 1 + q >= 0 and n.w[1] - 1 + q < len(highlighted_image)):
-                        highlighted_image[n.w[1] - 1 + q][n.w[0] - 1 + p] = intensity
-    
-        return highlighted_image
\ No newline at end of file
+        if (self.background is None):
+            self.intensity = numpy.max(self.image) * self.contrast
+            self.background = render.darken(self.image, self.contrast)
+        return render.render_neurons(self.background, self.weights, self.neuron_size, 
+                                     self.intensity)
\ No newline at end of file
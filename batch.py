@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Batch segmentation of many plates across a pool of processes.
+
+Plates are copied into shared memory blocks in chunks, so the workers only
+receive a block name and a table of shapes instead of pickled images. The
+workers send back rect coordinates and the sub images are cut out of the
+caller's own copies.
+"""
+
+import collections
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
+
+import numpy
+
+import rectfinder
+
+
+# warmed up segmenters of this worker process, by configuration
+segmenters = {}
+
+
+def segment_chunk(name, layout, area_min, area_max, max_mid_distance, engine):
+    """Worker side: traces every plate of a shared memory chunk and returns
+       a list of (top, bottom, left, right) rect tuples per plate.
+
+    Keyword arguments:
+    name -- name of the shared memory block
+    layout -- list of (offset, shape, dtype) for each plate in the block
+    area_min -- passed to Tracer
+    area_max -- passed to Tracer
+    max_mid_distance -- passed to Tracer
+    engine -- passed to Tracer
+    """
+    segmenter = segmenters.get((area_min, area_max, max_mid_distance, engine))
+    if (segmenter is None):
+        segmenter = rectfinder.Segmenter(area_min, area_max, max_mid_distance, engine)
+        segmenters[(area_min, area_max, max_mid_distance, engine)] = segmenter
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        results = []
+        for offset, shape, dtype in layout:
+            image = numpy.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+            rects = segmenter.run(image)
+            results.append([(r.top, r.bottom, r.left, r.right) for r in rects])
+            # drop the segmenter's view into shared memory so the block
+            # can be closed
+            segmenter.img = segmenter.img_state = segmenter.img_array = None
+            del image
+    finally:
+        block.close()
+    return results
+
+
+def share_chunk(plates):
+    """Copies a list of plates into a new shared memory block. Returns the
+       block and the (offset, shape, dtype) layout of the plates in it.
+
+    Keyword arguments:
+    plates -- list of 2D arrays
+    """
+    layout = []
+    size = 0
+    for p in plates:
+        layout.append((size, p.shape, p.dtype.str))
+        # keep every plate 8 byte aligned
+        size += (p.nbytes + 7) // 8 * 8
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for p, (offset, shape, dtype) in zip(plates, layout):
+        view = numpy.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+        view[...] = p
+        del view
+    return block, layout
+
+
+def release(block):
+    """Closes and removes a shared memory block"""
+    block.close()
+    block.unlink()
+    return
+
+
+def segment_batch(images, area_min, area_max, max_mid_distance, workers=None,
+                  ordered=True, chunk_size=16, engine='label'):
+    """Segments an iterable of plates across worker processes. Yields
+       (index, subimages) for every plate, where subimages is the list that
+       Tracer.extract_rects would return for it.
+
+    Keyword arguments:
+    images -- iterable of 2D plate arrays, consumed lazily
+    area_min -- the minimum area of a rect in percentage of image size (0-1)
+    area_max -- the maximum area of a rect in percentage of image size (0-1)
+    max_mid_distance -- the max dist rect can be from middle row of pixels
+                        in percentage of image size (0-1)
+    workers -- number of worker processes (default: number of cpus)
+    ordered -- yield plates in input order, otherwise as chunks complete
+    chunk_size -- number of plates sent to a worker at a time
+    engine -- Tracer engine used by the workers
+    """
+    if (workers is None):
+        workers = os.cpu_count() or 1
+    # enough chunks in flight to keep every worker busy while we yield
+    max_pending = 2 * workers
+
+    images = iter(images)
+    pending = collections.OrderedDict()     # future -> (start, plates, block)
+    index = 0
+    exhausted = False
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        try:
+            while (True):
+                # top up the pipeline
+                while (not exhausted and len(pending) < max_pending):
+                    plates = []
+                    for image in images:
+                        plates.append(numpy.ascontiguousarray(image))
+                        if (len(plates) == chunk_size):
+                            break
+                    if (len(plates) < chunk_size):
+                        exhausted = True
+                    if (len(plates) == 0):
+                        break
+                    block, layout = share_chunk(plates)
+                    future = pool.submit(segment_chunk, block.name, layout, area_min,
+                                         area_max, max_mid_distance, engine)
+                    pending[future] = (index, plates, block)
+                    index += len(plates)
+
+                if (len(pending) == 0):
+                    break
+
+                if (ordered):
+                    done = [next(iter(pending))]
+                    done[0].result()
+                else:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    start, plates, block = pending.pop(future)
+                    release(block)
+                    for i, rects in enumerate(future.result()):
+                        rects = [rectfinder.Rect(*r) for r in rects]
+                        yield start + i, rectfinder.extract_rects(rects, plates[i])
+        finally:
+            for future, (start, plates, block) in pending.items():
+                future.cancel()
+            concurrent.futures.wait(pending)
+            for start, plates, block in pending.values():
+                release(block)
+    return
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for flood box and SOM segmentation on synthetic plates.
+
+Run as a script, for example
+
+    python benchmark.py --plates 50 --noise 0.02 --output bench.json
+
+Every stage is timed separately and reported with its throughput and
+latency percentiles. The results are written as JSON so runs of different
+versions can be compared.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy
+
+import alpr_som
+import kernels
+import rectfinder
+
+
+def synthetic_plate(height, width, chars, noise, rng):
+    """Returns a preprocessed looking plate: white character outlines on a
+       black background with random white noise pixels.
+
+    Keyword arguments:
+    height -- height of the plate in pixels
+    width -- width of the plate in pixels
+    chars -- number of characters
+    noise -- fraction of pixels turned white at random (0-1)
+    rng -- numpy.random.Generator
+    """
+    plate = numpy.zeros((height, width), dtype=numpy.uint8)
+    top = int(height * 0.3)
+    bottom = int(height * 0.7)
+    pitch = (width - 40) / max(chars, 1)
+    stroke = max(1, height // 30)
+    for k in range(chars):
+        left = int(20 + k * pitch + pitch * 0.1)
+        right = int(20 + k * pitch + pitch * 0.7)
+        plate[top:bottom, left:right] = 255
+        plate[top + stroke:bottom - stroke, left + stroke:right - stroke] = 0
+        # a bar through some characters so they are not all boxes
+        if (rng.random() < 0.5):
+            middle = (top + bottom) // 2
+            plate[middle:middle + stroke, left:right] = 255
+    plate[rng.random((height, width)) < noise] = 255
+    return plate
+
+
+def summarize(samples, items=1):
+    """Returns throughput and latency statistics of a list of timings
+
+    Keyword arguments:
+    samples -- durations in seconds
+    items -- number of items processed per sample
+    """
+    samples = numpy.asarray(samples, dtype=float)
+    total = float(samples.sum())
+    return {
+        'count': len(samples),
+        'total_s': total,
+        'mean_ms': float(samples.mean() * 1000),
+        'p50_ms': float(numpy.percentile(samples, 50) * 1000),
+        'p90_ms': float(numpy.percentile(samples, 90) * 1000),
+        'p99_ms': float(numpy.percentile(samples, 99) * 1000),
+        'max_ms': float(samples.max() * 1000),
+        'per_s': len(samples) * items / total if (total > 0) else None,
+    }
+
+
+def bench_tracer(plates, args):
+    """Times Tracer construction for each engine and extract_rects"""
+    results = {}
+    for engine in args.engines:
+        construct = []
+        extract = []
+        for plate in plates:
+            start = time.perf_counter()
+            tracer = rectfinder.Tracer(plate, args.area_min, args.area_max,
+                                       args.max_mid_distance, engine=engine,
+                                       coarse=args.coarse, threads=args.threads)
+            construct.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            tracer.extract_rects(plate)
+            extract.append(time.perf_counter() - start)
+        results['tracer_%s' % engine] = summarize(construct)
+        results['extract_rects_%s' % engine] = summarize(extract)
+    return results
+
+
+def make_som(plate, args, seed):
+    """Returns an UnchainedSOM on a plate set up the same way for every run"""
+    som = alpr_som.UnchainedSOM(plate, args.learnrate, args.ldecay, 1, args.som_epochs,
+                                args.som_epochs + 1, 2, 3, batch_size=args.batch_size,
+                                rng=seed)
+    som.init_neurons_grid(args.grid[0], args.grid[1])
+    return som
+
+
+def bench_som(plates, args):
+    """Times UnchainedSOM.start and the phases of single sample epochs"""
+    runs = []
+    for i, plate in enumerate(plates[:args.som_plates]):
+        som = make_som(plate, args, i)
+        start = time.perf_counter()
+        som.start()
+        runs.append(time.perf_counter() - start)
+    results = {'som_start': summarize(runs)}
+
+    phases = {'sample': [], 'find_winner': [], 'calculate_neighborhood': [],
+              'adjust_weights': []}
+    som = make_som(plates[0], args, 0)
+    for t in range(1, args.som_epochs):
+        start = time.perf_counter()
+        xs, ys = som.sample_pixels(1)
+        x = xs[0]
+        y = ys[0]
+        found = time.perf_counter()
+        winner = som.find_winner(x, y)
+        won = time.perf_counter()
+        som.calculate_neighborhood(x, y, winner, t)
+        neighbors = time.perf_counter()
+        som.adjust_weights(x, y, t)
+        adjusted = time.perf_counter()
+        phases['sample'].append(found - start)
+        phases['find_winner'].append(won - found)
+        phases['calculate_neighborhood'].append(neighbors - won)
+        phases['adjust_weights'].append(adjusted - neighbors)
+    for name, samples in phases.items():
+        results['som_epoch_%s' % name] = summarize(samples)
+    return results
+
+
+def check_backends(plates, args):
+    """Compares the python and numba backends: the rects the flood engine
+       accepts on every plate, and the weights after single SOM epochs 
+       stepped from the same state. Returns the number of mismatches.
+    """
+    mismatched_plates = 0
+    for plate in plates:
+        found = []
+        for backend in kernels.BACKENDS:
+            tracer = rectfinder.Tracer(plate, args.area_min, args.area_max,
+                                       args.max_mid_distance, backend=backend)
+            found.append(tracer.rects.view.tolist())
+        mismatched_plates += found[0] != found[1]
+    
+    # training amplifies rounding differences, so epochs are compared one
+    # at a time from a shared state
+    mismatched_epochs = 0
+    worst = 0.0
+    for i, plate in enumerate(plates[:max(args.som_plates, 1)]):
+        soms = [make_som(plate, args, i) for backend in kernels.BACKENDS]
+        for som, backend in zip(soms, kernels.BACKENDS):
+            som.backend = backend
+        reference, compiled = soms
+        for t in range(1, args.som_epochs):
+            compiled.weights[...] = reference.weights
+            reference.epoch(t)
+            compiled.epoch(t)
+            error = float(numpy.abs(reference.weights - compiled.weights).max())
+            worst = max(worst, error)
+            mismatched_epochs += not numpy.allclose(reference.weights, compiled.weights, 
+                                                    rtol=1e-9, atol=1e-9)
+    return {
+        'tracer_mismatched_plates': mismatched_plates,
+        'som_mismatched_epochs': mismatched_epochs,
+        'som_max_weight_error': worst,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--plates', type=int, default=50, help='number of plates')
+    parser.add_argument('--height', type=int, default=120, help='plate height')
+    parser.add_argument('--width', type=int, default=400, help='plate width')
+    parser.add_argument('--chars', type=int, default=7, help='characters per plate')
+    parser.add_argument('--noise', type=float, default=0.02, help='noise pixel density')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--engines', nargs='+', default=['flood', 'label'],
+                        help='Tracer engines to time')
+    parser.add_argument('--area-min', type=float, default=0.0005)
+    parser.add_argument('--area-max', type=float, default=0.2)
+    parser.add_argument('--max-mid-distance', type=float, default=0.6)
+    parser.add_argument('--coarse', type=int, default=0,
+                        help='downscale factor of the Tracer coarse pass (0 is off)')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='labeling threads of the label engine')
+    parser.add_argument('--som-plates', type=int, default=3,
+                        help='number of plates to run the SOM on (0 skips it)')
+    parser.add_argument('--som-epochs', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--grid', type=int, nargs=2, default=[12, 3])
+    parser.add_argument('--learnrate', type=float, default=0.5)
+    parser.add_argument('--ldecay', type=float, default=1000)
+    parser.add_argument('--parity', action='store_true',
+                        help='compare the python and numba backends instead of timing')
+    parser.add_argument('--output', default='bench.json', help='JSON file to write')
+    args = parser.parse_args(argv)
+
+    rng = numpy.random.default_rng(args.seed)
+    plates = [synthetic_plate(args.height, args.width, args.chars, args.noise, rng)
+              for i in range(args.plates)]
+
+    if (args.parity):
+        if (kernels.numba is None):
+            parser.error('--parity needs numba, tests/test_kernels.py checks the '
+                         'kernels without it')
+        parity = check_backends(plates, args)
+        print(json.dumps(parity, indent=2))
+        return parity
+
+    results = bench_tracer(plates, args)
+    if (args.som_plates > 0):
+        results.update(bench_som(plates, args))
+
+    report = {
+        'config': vars(args),
+        'environment': {
+            'python': sys.version.split()[0],
+            'numpy': numpy.__version__,
+            'backend': kernels.BACKEND,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, r in results.items():
+        print('%-36s p50 %9.3f ms  p99 %9.3f ms  %10.1f /s'
+              % (name, r['p50_ms'], r['p99_ms'], r['per_s'] or 0))
+    return report
+
+
+if __name__ == '__main__':
+    main()
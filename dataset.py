@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk segmentation of archived plates for offline parameter tuning.
+
+Plates are read from a memory-mapped stack, either an (n, height, width)
+uint8 .npy file or a raw uint8 volume of plates of any size with an index
+file next to it (see write_stack). Every plate is labeled once and then
+filtered with each setting of a parameter grid through Tracer.rerun, so a
+sweep does not trace the same pixels again for every combination. The rects
+go to a columnar table with one row per rect.
+
+Run as a script, for example
+
+    python dataset.py plates.npy --area-min 0.0005 0.001 --max-mid-distance 0.4 0.6
+"""
+
+import argparse
+import itertools
+import os
+
+import numpy
+
+import rectfinder
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# index of a raw plate volume: where each plate starts and its size
+INDEX_DTYPE = numpy.dtype([('offset', numpy.int64), ('height', numpy.int32),
+                           ('width', numpy.int32)])
+
+
+def index_path(path):
+    """Returns the index file name of a raw plate volume"""
+    return path + '.index.npy'
+
+
+def write_stack(path, plates):
+    """Writes plates of any size to a raw uint8 volume and its index
+
+    Keyword arguments:
+    path -- file to write, the index goes to index_path(path)
+    plates -- iterable of 2D preprocessed plates
+    """
+    index = []
+    offset = 0
+    with open(path, 'wb') as f:
+        for plate in plates:
+            plate = numpy.ascontiguousarray(plate, dtype=numpy.uint8)
+            f.write(plate.tobytes())
+            index.append((offset, plate.shape[0], plate.shape[1]))
+            offset += plate.nbytes
+    numpy.save(index_path(path), numpy.array(index, dtype=INDEX_DTYPE))
+    return
+
+
+class PlateStack():
+    """Read only, memory-mapped sequence of plates"""
+
+    def __init__(self, path):
+        """PlateStack init
+
+        Keyword arguments:
+        path -- an (n, height, width) .npy file, or a raw volume written by
+                write_stack
+        """
+        self.path = path
+        if (path.endswith('.npy')):
+            self.data = numpy.load(path, mmap_mode='r')
+            if (self.data.ndim != 3):
+                raise ValueError('expected an (n, height, width) stack, got shape %s'
+                                 % (self.data.shape,))
+            self.index = None
+        else:
+            self.data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+            self.index = numpy.load(index_path(path))
+        return
+
+    def __len__(self):
+        if (self.index is None):
+            return len(self.data)
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if (self.index is None):
+            return self.data[i]
+        offset, height, width = self.index[i].tolist()
+        return self.data[offset:offset + height * width].reshape(height, width)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class RectTable():
+    """Columnar table of rects: plate index, setting index, bounds and seed
+       position, one row per rect
+    """
+    columns = ('plate', 'setting', 'top', 'bottom', 'left', 'right', 'seed')
+
+    def __init__(self):
+        self.chunks = {name: [] for name in self.columns}
+        return
+
+    def add(self, plate, setting, bounds):
+        """Adds the accepted rects of one plate and setting
+
+        Keyword arguments:
+        plate -- index of the plate
+        setting -- index of the parameter setting
+        bounds -- structured array of rects, as RectStore.view
+        """
+        n = len(bounds)
+        self.chunks['plate'].append(numpy.full(n, plate, dtype=numpy.int32))
+        self.chunks['setting'].append(numpy.full(n, setting, dtype=numpy.int32))
+        for name in ('top', 'bottom', 'left', 'right', 'seed'):
+            # copied, the store is overwritten by the next run
+            self.chunks[name].append(numpy.array(bounds[name]))
+        return
+
+    def __len__(self):
+        return sum(len(c) for c in self.chunks['plate'])
+
+    def arrays(self):
+        """Returns a dict of one array per column"""
+        arrays = {}
+        for name in self.columns:
+            chunks = self.chunks[name]
+            if (len(chunks) > 1):
+                # keep one chunk so later calls are free
+                chunks[:] = [numpy.concatenate(chunks)]
+            arrays[name] = chunks[0] if (len(chunks) > 0) else numpy.zeros(0, dtype=numpy.int32)
+        return arrays
+
+    def save(self, path, settings=None):
+        """Writes the table, as parquet when the path ends in .parquet and
+           pyarrow is installed, otherwise as an .npz with one array per
+           column
+
+        Keyword arguments:
+        path -- file to write
+        settings -- optional (area_min, area_max, max_mid_distance) list the
+                    setting column indexes, stored alongside
+        """
+        arrays = self.arrays()
+        if (path.endswith('.parquet')):
+            if (pyarrow is None):
+                raise ImportError('writing parquet needs pyarrow to be installed')
+            table = pyarrow.table(arrays)
+            if (settings is not None):
+                table = table.replace_schema_metadata({'settings': repr(list(settings))})
+            pyarrow.parquet.write_table(table, path)
+        else:
+            if (settings is not None):
+                arrays['settings'] = numpy.array(settings, dtype=float).reshape(-1, 3)
+            numpy.savez(path, **arrays)
+        return
+
+
+def grid(area_min, area_max, max_mid_distance):
+    """Returns every (area_min, area_max, max_mid_distance) combination
+
+    Keyword arguments:
+    area_min -- list of minimum rect areas
+    area_max -- list of maximum rect areas
+    max_mid_distance -- list of max distances from the middle row
+    """
+    return list(itertools.product(area_min, area_max, max_mid_distance))
+
+
+def sweep(plates, settings, table=None, metrics=None):
+    """Segments every plate with every setting and returns a RectTable.
+       Each plate is labeled once, the other settings only filter its
+       clusters again.
+
+    Keyword arguments:
+    plates -- PlateStack or any sequence of plates
+    settings -- list of (area_min, area_max, max_mid_distance)
+    table -- RectTable to add to, a new one if None
+    metrics -- instrument.Metrics for the segmenter
+    """
+    if (table is None):
+        table = RectTable()
+    segmenter = rectfinder.Segmenter(*settings[0], engine='label', metrics=metrics)
+    for index, plate in enumerate(plates):
+        # rerun leaves the thresholds of the last setting behind
+        segmenter.area_min, segmenter.area_max, segmenter.max_mid_distance = settings[0]
+        table.add(index, 0, segmenter.run(plate).view)
+        for k in range(1, len(settings)):
+            table.add(index, k, segmenter.rerun(*settings[k]).view)
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('stack', help='.npy plate stack or raw volume with an index')
+    parser.add_argument('--area-min', type=float, nargs='+', default=[0.0005])
+    parser.add_argument('--area-max', type=float, nargs='+', default=[0.2])
+    parser.add_argument('--max-mid-distance', type=float, nargs='+', default=[0.6])
+    parser.add_argument('--output', default='rects.npz',
+                        help='table to write (.npz, or .parquet with pyarrow)')
+    args = parser.parse_args(argv)
+
+    plates = PlateStack(args.stack)
+    settings = grid(args.area_min, args.area_max, args.max_mid_distance)
+    table = sweep(plates, settings)
+    table.save(args.output, settings)
+    print('%d plates, %d settings, %d rects written to %s'
+          % (len(plates), len(settings), len(table), os.path.abspath(args.output)))
+    return table
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight counters and phase timers for Tracer and UnchainedSOM.
+
+Pass a Metrics object to a Tracer or UnchainedSOM to find out why a plate
+was slow (a huge cluster, many rejects, long win cycles, ...). Without one
+they use NULL, whose methods do nothing, and the hot loops skip their
+bookkeeping entirely.
+"""
+
+import time
+
+
+class Timer():
+    """Context manager adding the time spent inside it to a Metrics timer"""
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer():
+    """Context manager that does nothing"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Metrics():
+    """Collects counters, maxima and timers by name. A callback, if given,
+       is called with (source, summary) whenever a Tracer run or SOM
+       training finishes.
+    """
+    enabled = True
+
+    def __init__(self, callback=None):
+        """Metrics init
+
+        Keyword arguments:
+        callback -- optional function(source, summary) called by report
+        """
+        self.callback = callback
+        self.reset()
+        return
+
+    def reset(self):
+        """Clears every counter, maximum and timer"""
+        self.counters = {}
+        self.maxima = {}
+        self.timers = {}
+        self.timer_counts = {}
+        return
+
+    def count(self, name, n=1):
+        """Adds n to a counter
+
+        Keyword arguments:
+        name -- counter name
+        n -- amount to add
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+        return
+
+    def maximum(self, name, value):
+        """Keeps the largest value seen for a name
+
+        Keyword arguments:
+        name -- maximum name
+        value -- value seen
+        """
+        if (value > self.maxima.get(name, value - 1)):
+            self.maxima[name] = value
+        return
+
+    def add_time(self, name, seconds):
+        """Adds a duration to a timer
+
+        Keyword arguments:
+        name -- timer name
+        seconds -- duration to add
+        """
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+        self.timer_counts[name] = self.timer_counts.get(name, 0) + 1
+        return
+
+    def timer(self, name):
+        """Returns a context manager timing its block into a timer
+
+        Keyword arguments:
+        name -- timer name
+        """
+        return Timer(self, name)
+
+    def summary(self):
+        """Returns a dict with copies of all counters, maxima and timers"""
+        return {
+            'counters': dict(self.counters),
+            'maxima': dict(self.maxima),
+            'timers': dict(self.timers),
+            'timer_counts': dict(self.timer_counts),
+        }
+
+    def report(self, source):
+        """Hands the current summary to the callback
+
+        Keyword arguments:
+        source -- name of the reporting component, e.g. 'tracer' or 'som'
+        """
+        if (self.callback is not None):
+            self.callback(source, self.summary())
+        return
+
+
+class NullMetrics(Metrics):
+    """Metrics that record nothing"""
+    enabled = False
+    null_timer = NullTimer()
+
+    def __init__(self):
+        return
+
+    def reset(self):
+        return
+
+    def count(self, name, n=1):
+        return
+
+    def maximum(self, name, value):
+        return
+
+    def add_time(self, name, seconds):
+        return
+
+    def timer(self, name):
+        return self.null_timer
+
+    def summary(self):
+        return {'counters': {}, 'maxima': {}, 'timers': {}, 'timer_counts': {}}
+
+    def report(self, source):
+        return
+
+
+# shared do-nothing metrics used when none are given
+NULL = NullMetrics()
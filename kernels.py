@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled kernels for the flood fill of Tracer.trace and the single sample
+epoch of UnchainedSOM.
+
+The kernels are written as plain loops and compiled with numba when it can
+be imported. BACKEND is picked at import time: 'numba' when numba is
+available, 'python' otherwise, in which case Tracer and UnchainedSOM keep
+using their own code. Set the ALPR_BACKEND environment variable to 'python'
+or 'numba' to force one of them, or pass backend= to a Tracer or
+UnchainedSOM.
+"""
+
+import math
+import os
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+BACKENDS = ('python', 'numba')
+
+
+def choose_backend(backend=None):
+    """Returns the backend to use, checking that it is available
+
+    Keyword arguments:
+    backend -- 'python', 'numba', or None for the import time default
+    """
+    if (backend is None):
+        backend = BACKEND
+    if (backend not in BACKENDS):
+        raise ValueError("unknown backend '%s'" % backend)
+    if (backend == 'numba' and numba is None):
+        raise ImportError("the numba backend needs numba to be installed")
+    return backend
+
+
+def jit(function):
+    """Compiles a kernel with numba, or returns it unchanged without it"""
+    if (numba is None):
+        return function
+    return numba.njit(cache=True, nogil=True, error_model='numpy')(function)
+
+
+@jit
+def flood(img, visited, stack, x, y, max_size):
+    """Floods the cluster at x, y with the same moves as Tracer.trace and
+       returns (top, bottom, left, right, flooded, depth, abandoned). Once
+       the bounds cover more than max_size pixels they stop growing, the
+       rest of the cluster is only marked visited and abandoned is True.
+
+    Keyword arguments:
+    img -- 2D image array
+    visited -- uint8 array of visited pixels, updated in place
+    stack -- int64 scratch array with room for every pixel of the image
+    x -- point x position to start the flood
+    y -- point y position to start the flood
+    max_size -- area at which the bounds are abandoned
+    """
+    height, width = img.shape
+    top = y
+    bottom = y
+    left = x
+    right = x
+    flooded = 0
+    depth = 1
+    abandoned = False
+
+    # points are marked when pushed, so each one is pushed at most once
+    visited[y, x] = 1
+    stack[0] = y * width + x
+    size = 1
+    while (size > 0):
+        size -= 1
+        py = stack[size] // width
+        px = stack[size] - py * width
+        if (img[py, px] == 0):
+            continue
+
+        if (not abandoned):
+            if (px < left):
+                left = px
+            elif (px > right):
+                right = px
+            if (py < top):
+                top = py
+            elif (py > bottom):
+                bottom = py
+            flooded += 1
+            if (flooded % 64 == 0 and
+                (bottom - top + 1) * (right - left + 1) > max_size):
+                abandoned = True
+
+        if (px + 1 < width - 10 and visited[py, px + 1] == 0):
+            visited[py, px + 1] = 1
+            stack[size] = py * width + px + 1
+            size += 1
+        if (px - 1 > 10 and visited[py, px - 1] == 0):
+            visited[py, px - 1] = 1
+            stack[size] = py * width + px - 1
+            size += 1
+        if (py + 1 < height - 10 and visited[py + 1, px] == 0):
+            visited[py + 1, px] = 1
+            stack[size] = (py + 1) * width + px
+            size += 1
+        if (py - 1 > 10 and visited[py - 1, px] == 0):
+            visited[py - 1, px] = 1
+            stack[size] = (py - 1) * width + px
+            size += 1
+        if (size > depth):
+            depth = size
+    return top, bottom, left, right, flooded, depth, abandoned
+
+
+@jit
+def som_epoch(weights, neighborhood, win_count, win_cycle, cycle, win_limit, x, y,
+              time, learning_rate):
+    """One SOM epoch for the sample x, y: finds the closest neuron still
+       allowed to win, writes the neighborhood of every neuron and moves the
+       weights, the same way as UnchainedSOM.find_winner,
+       calculate_neighborhood and adjust_weights. Returns the winner, the
+       win counts are left to the caller.
+
+    Keyword arguments:
+    weights -- (N, 2) float array of neuron x, y positions, updated in place
+    neighborhood -- (N,) float array, overwritten
+    win_count -- (N,) wins of each neuron in the cycle of win_cycle
+    win_cycle -- (N,) competition cycle each win count belongs to
+    cycle -- current competition cycle
+    win_limit -- wins allowed per neuron and cycle
+    x -- x location of the sample
+    y -- y location of the sample
+    time -- current epoch
+    learning_rate -- learning rate of this epoch
+    """
+    n = weights.shape[0]
+    winner = -1
+    best = math.inf
+    for i in range(n):
+        if (win_cycle[i] == cycle and win_count[i] >= win_limit):
+            continue
+        distance = (x - weights[i, 0]) ** 2 + (y - weights[i, 1]) ** 2
+        if (winner < 0 or distance < best):
+            winner = i
+            best = distance
+    if (winner < 0):
+        return winner
+
+    w_x = weights[winner, 0]
+    w_y = weights[winner, 1]
+    d2 = math.sqrt((w_x - x) ** 2 + (w_y - y) ** 2)
+    for i in range(n):
+        c_x = weights[i, 0]
+        c_y = weights[i, 1]
+        if (w_x == c_x and w_y == c_y):
+            neighborhood[i] = 1.0
+            continue
+        d1 = math.sqrt((w_x - c_x) ** 2 + (w_y - c_y) ** 2)
+        if (d1 == 0 or d2 == 0):
+            neighborhood[i] = 0.0
+            continue
+        d3 = math.sqrt((c_x - x) ** 2 + (c_y - y) ** 2)
+        value = (d1 ** 2 + d2 ** 2 - d3 ** 2) / (2 * d1 * d2)
+        value = min(max(value, -1.0), 1.0)
+        lateral_distance = d1 * math.cos(math.acos(value))
+        if (lateral_distance == 0):
+            neighborhood[i] = math.inf
+        else:
+            neighborhood[i] = 1 / (lateral_distance * time)
+
+    for i in range(n):
+        step = learning_rate * neighborhood[i]
+        weights[i, 0] += step * (x - weights[i, 0])
+        weights[i, 1] += step * (y - weights[i, 1])
+    return winner
+
+
+# backend picked at import time, see choose_backend
+BACKEND = os.environ.get('ALPR_BACKEND', 'numba' if (numba is not None) else 'python')
+BACKEND = choose_backend(BACKEND)
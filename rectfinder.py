@@ -5,12 +5,20 @@ Created on Wed Jan 25 13:02:19 2017
 @author: Nick Areias, Jeffrey Paquette
 """
 
+import concurrent.futures
+import heapq
+import time
 import numpy
-import scipy.misc
-import filters
+import scipy.ndimage
+import instrument
+import kernels
+import render
+import snapshots
 
 class Point():
     """Container for a single 2D point"""
+    __slots__ = ('x', 'y')
+    
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -22,7 +30,7 @@ class Rect():
     #bottom = 0     # bottom edge of rect
     #left = 0       # left edge of rect
     #right = 0      # right edge of rect
-    #area = 0       # area of rect
+    __slots__ = ('top', 'bottom', 'left', 'right')
     
     def __init__(self, top, bottom, left, right):
         """Rect init
@@ -37,13 +45,16 @@ class Rect():
         self.bottom = bottom
         self.left = left
         self.right = right
-        self.calculate_area()
         return
     
+    @property
+    def area(self):
+        """Area of the rect (min=1), computed when asked for"""
+        return self.calculate_area()
+    
     def calculate_area(self):
         """Returns the area of a rectangle (min=1)"""
-        self.area = (self.bottom - self.top + 1) * (self.right - self.left + 1)
-        return
+        return (self.bottom - self.top + 1) * (self.right - self.left + 1)
         
     def isAdjacent(self, x, y):
         """Returns true if this point is adjacent to this rect
@@ -91,11 +102,511 @@ class Rect():
             self.top = y
         elif (y > self.bottom):
             self.bottom = y
+        return
+                
+class RectStore():
+    """Rects found in an image, kept as a structured array of bounds with a 
+       coverage map for constant time point queries.
+       
+       A rect is added while it is still being traced and is then either 
+       accepted, which writes its bounds and the raster position of the 
+       pixel it was seeded from to the array, or rejected, which just drops
+       it. Iterating a store yields Rects for the accepted rows in
+       the order they were accepted, followed by the rect being traced.
+    """
+    dtype = numpy.dtype([('top', numpy.int32), ('bottom', numpy.int32), 
+                         ('left', numpy.int32), ('right', numpy.int32), 
+                         ('seed', numpy.int64)])
+    
+    def __init__(self, width, height, capacity=16):
+        """RectStore init
+        
+        Keyword arguments:
+        width -- width of the image the rects live in
+        height -- height of the image the rects live in
+        capacity -- number of rows to allocate up front
+        """
+        self.bounds = numpy.zeros(capacity, dtype=self.dtype)
+        self.count = 0          # number of accepted rects
+        self.pending = None     # rect currently being traced
+        self.seed = -1          # seed position of the pending rect
+        
+        # number of accepted rects covering each pixel
+        self.coverage = numpy.zeros((height, width), dtype=numpy.int32)
+        return
+    
+    def clear(self):
+        """Removes every rect, keeping the allocated arrays. Only the areas 
+           of the accepted rects are cleared from the coverage map.
+        """
+        for top, bottom, left, right, seed in self.bounds[:self.count].tolist():
+            self.coverage[top:bottom + 1, left:right + 1] = 0
+        self.count = 0
+        self.pending = None
+        return
+    
+    def __len__(self):
+        return self.count + (self.pending is not None)
+    
+    def __iter__(self):
+        for top, bottom, left, right, seed in self.bounds[:self.count].tolist():
+            yield Rect(top, bottom, left, right)
+        if (self.pending is not None):
+            yield self.pending
+    
+    def __getitem__(self, i):
+        if (isinstance(i, slice)):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        n = len(self)
+        if (i < 0):
+            i += n
+        if (i < 0 or i >= n):
+            raise IndexError('rect index out of range')
+        if (i == self.count):
+            return self.pending
+        top, bottom, left, right, seed = self.bounds[i].tolist()
+        return Rect(top, bottom, left, right)
+    
+    @property
+    def view(self):
+        """Structured array view of the accepted rect bounds"""
+        return self.bounds[:self.count]
+    
+    def as_array(self):
+        """Returns an (n, 4) array of [top, bottom, left, right] for every 
+           rect iteration yields, the rect being traced last
+        """
+        b = self.view
+        bounds = numpy.stack([b['top'], b['bottom'], b['left'], b['right']], axis=1)
+        if (self.pending is not None):
+            r = self.pending
+            bounds = numpy.concatenate([bounds, [[r.top, r.bottom, r.left, r.right]]])
+        return bounds
+    
+    def append(self, rect, seed=-1):
+        """Adds a rect that is still being traced
+        
+        Keyword arguments:
+        rect -- the rect to add
+        seed -- raster position (y * width + x) the rect was seeded from
+        """
+        self.pending = rect
+        self.seed = seed
+        return
+    
+    def accept(self, rect):
+        """Stores the bounds of a finished rect and marks its area as covered
         
-        # update area calculation
-        self.calculate_area()
+        Keyword arguments:
+        rect -- the finished rect
+        """
+        if (self.count == len(self.bounds)):
+            self.bounds = numpy.resize(self.bounds, 2 * len(self.bounds))
+        self.bounds[self.count] = (rect.top, rect.bottom, rect.left, rect.right, self.seed)
+        self.count += 1
+        self.coverage[rect.top:rect.bottom + 1, rect.left:rect.right + 1] += 1
+        self.pending = None
         return
+    
+    def reject(self, rect):
+        """Drops a finished rect
+        
+        Keyword arguments:
+        rect -- the finished rect
+        """
+        self.pending = None
+        return
+    
+    def area(self):
+        """Returns the areas of all accepted rects"""
+        b = self.view
+        return (b['bottom'] - b['top'] + 1) * (b['right'] - b['left'] + 1)
+    
+    def contains(self, x, y):
+        """Returns true if this point is inside any accepted rect
+        
+        Keyword arguments:
+        x -- point x position
+        y -- point y position
+        """
+        return self.coverage[y, x] > 0
+    
+    def containing(self, x, y):
+        """Returns a mask of the accepted rects this point is inside of
+        
+        Keyword arguments:
+        x -- point x position
+        y -- point y position
+        """
+        b = self.view
+        return ((x >= b['left']) & (x <= b['right']) & 
+                (y >= b['top']) & (y <= b['bottom']))
+    
+    def isAdjacent(self, x, y):
+        """Returns a mask of the accepted rects this point is adjacent to
+        
+        Keyword arguments:
+        x -- point x position
+        y -- point y position
+        """
+        b = self.view
+        in_rows = (y >= b['top']) & (y <= b['bottom'])
+        in_cols = (x >= b['left']) & (x <= b['right'])
+        return (((x + 1 == b['left']) & in_rows) | ((x - 1 == b['right']) & in_rows) | 
+                ((y - 1 == b['bottom']) & in_cols) | ((y + 1 == b['top']) & in_cols))
+    
+def reading_order(rects):
+    """Returns an (n, 4) array of [top, bottom, left, right] rect bounds 
+       sorted left to right, then top to bottom
+    
+    Keyword arguments:
+    rects -- list or RectStore of rects
+    """
+    if (isinstance(rects, RectStore)):
+        b = rects.view
+        bounds = numpy.stack([b['top'], b['bottom'], b['left'], b['right']], axis=1)
+    else:
+        bounds = numpy.array([[r.top, r.bottom, r.left, r.right] for r in rects], 
+                             dtype=numpy.int32).reshape(-1, 4)
+    return bounds[numpy.lexsort((bounds[:, 0], bounds[:, 2]))]
+    
+def extract_rects(rects, original):
+    """Extracts sub images of original based on rectangle coordinates.
+       Returns a list of read only views of these images ordered left to 
+       right
+    
+    Keyword arguments:
+    rects -- list or RectStore of rects to cut out
+    original -- the image to cut them from
+    """
+    images = []     # list of images cut out from origin
+    original = numpy.asarray(original)
+    
+    #slice images and place them in the array                    
+    for top, bottom, left, right in reading_order(rects):
+        image = original[top:bottom, left:right]
+        image.flags.writeable = False
+        images.append(image)
+    return images
+    
+def pack_rects(rects, original, out=None):
+    """Copies the sub images extract_rects would return into one flat 
+       buffer. Returns the buffer and a table with the offset, height, 
+       width, top and left of each sub image in it, ordered left to right.
+    
+    Keyword arguments:
+    rects -- list or RectStore of rects to cut out
+    original -- the image to cut them from
+    out -- optional buffer to reuse, used when it is large enough
+    """
+    original = numpy.asarray(original)
+    bounds = reading_order(rects)
+    table = numpy.zeros(len(bounds), dtype=[('offset', numpy.int64), ('height', numpy.int32), 
+                                            ('width', numpy.int32), ('top', numpy.int32), 
+                                            ('left', numpy.int32)])
+    table['height'] = numpy.maximum(bounds[:, 1] - bounds[:, 0], 0)
+    table['width'] = numpy.maximum(bounds[:, 3] - bounds[:, 2], 0)
+    table['top'] = bounds[:, 0]
+    table['left'] = bounds[:, 2]
+    sizes = table['height'].astype(numpy.int64) * table['width']
+    table['offset'][1:] = numpy.cumsum(sizes)[:-1]
+    
+    size = int(sizes.sum())
+    if (out is None or len(out) < size or out.dtype != original.dtype):
+        out = numpy.empty(size, dtype=original.dtype)
+    for (offset, height, width, top, left), n in zip(table.tolist(), sizes.tolist()):
+        out[offset:offset + n].reshape(height, width)[...] = original[top:top + height, left:left + width]
+    return out, table
+    
+def resample_rects(rects, original, height, width):
+    """Returns an (n, height, width) array with the sub images extract_rects
+       would return, each resampled to height x width (nearest neighbor), 
+       ordered left to right.
+    
+    Keyword arguments:
+    rects -- list or RectStore of rects to cut out
+    original -- the image to cut them from
+    height -- height of each output image
+    width -- width of each output image
+    """
+    original = numpy.asarray(original)
+    bounds = reading_order(rects)
+    heights = numpy.maximum(bounds[:, 1] - bounds[:, 0], 1)
+    widths = numpy.maximum(bounds[:, 3] - bounds[:, 2], 1)
+    
+    # source row and column of every output pixel, for all images at once
+    rows = bounds[:, 0, None] + ((numpy.arange(height) + 0.5) * heights[:, None] / height).astype(int)
+    cols = bounds[:, 2, None] + ((numpy.arange(width) + 0.5) * widths[:, None] / width).astype(int)
+    return original[rows[:, :, None], cols[:, None, :]]
+
+def mid_rows(height, max_mid_distance):
+    """Returns the (first, last) rows that every rect accepted by a Tracer 
+       must reach into, given the max distance from the middle row.
+    
+    Keyword arguments:
+    height -- height of the image
+    max_mid_distance -- the max dist rect can be from middle row of pixels 
+                        in percentage of image size (0-1)
+    """
+    mid_y = height / 2
+    first = int(numpy.floor(mid_y - max_mid_distance * mid_y))
+    last = int(numpy.ceil(mid_y + max_mid_distance * mid_y))
+    return first, last
+
+def coarse_band(image, max_mid_distance, factor=4, roi=None):
+    """Returns a (top, bottom) band of rows holding every cluster that 
+       reaches both the middle rows and the region of interest if there is 
+       one, found on a downscaled copy of the image. Clusters outside the band 
+       would be rejected for their distance from the middle row (or the 
+       region of interest) anyway, so a Tracer scanning only the band 
+       accepts the same rects.
+       
+       Each coarse pixel is set when any pixel of its factor x factor block
+       is, so two touching pixels always fall in the same or touching coarse
+       pixels and a coarse cluster holds every full size cluster inside it.
+    
+    Keyword arguments:
+    image -- the preprocessed image
+    max_mid_distance -- the max dist rect can be from middle row of pixels 
+                        in percentage of image size (0-1)
+    factor -- downscale factor of the coarse pass
+    roi -- optional (first, last) rows every rect must reach into
+    """
+    img = numpy.asarray(image)
+    height, width = img.shape
+    if (height <= 20 or width <= 20):
+        return 10, 10
+    # row ranges every accepted rect reaches into, clipped to the scan
+    ranges = [mid_rows(height, max_mid_distance)]
+    if (roi is not None):
+        ranges.append(roi)
+    ranges = [(max(first, 10), min(last, height - 11)) for first, last in ranges]
+    if (all(first <= 10 and last >= height - 11 for first, last in ranges)):
+        # every row can hold an accepted rect
+        return 10, height - 10
+    if (any(first > last for first, last in ranges)):
+        return 10, 10
+    
+    # block maximum of the scanned region, padded to whole blocks
+    region = img[10:height-10, 10:width-10] != 0
+    rows = -(-region.shape[0] // factor)
+    cols = -(-region.shape[1] // factor)
+    padded = numpy.zeros((rows * factor, cols * factor), dtype=bool)
+    padded[:region.shape[0], :region.shape[1]] = region
+    coarse = padded.reshape(rows, factor, cols, factor).any(axis=(1, 3))
+    
+    # coarse clusters reaching every row range, and the rows they span
+    labels, count = scipy.ndimage.label(coarse)
+    found = None
+    for first, last in ranges:
+        reached = labels[(first - 10) // factor:(last - 10) // factor + 1]
+        reached = numpy.unique(reached[reached > 0])
+        found = reached if (found is None) else numpy.intersect1d(found, reached)
+    if (len(found) == 0):
+        return 10, 10
+    spans = numpy.flatnonzero(numpy.isin(labels, found).any(axis=1))
+    top = 10 + int(spans[0]) * factor
+    bottom = min(10 + (int(spans[-1]) + 1) * factor, height - 10)
+    return top, bottom
+
+def merge_labels(pairs, count):
+    """Union-find over component labels. Returns a lookup array mapping 
+       every label 0..count to a merged label numbered from 1 (0 stays 0),
+       and the number of merged labels.
+    
+    Keyword arguments:
+    pairs -- (n, 2) array of labels that belong to the same component
+    count -- highest label
+    """
+    parent = numpy.arange(count + 1)
+    
+    def find(a):
+        while (parent[a] != a):
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+    
+    for a, b in pairs.tolist():
+        a = find(a)
+        b = find(b)
+        if (a != b):
+            parent[max(a, b)] = min(a, b)
+            
+    # point every label at its root, then number the roots
+    while (True):
+        grand = parent[parent]
+        if ((grand == parent).all()):
+            break
+        parent = grand
+    roots, lookup = numpy.unique(parent, return_inverse=True)
+    return lookup.astype(numpy.int32), len(roots) - 1
+
+def label_strips(mask, strips, executor):
+    """Labels the 4-connected components of a mask like scipy.ndimage.label,
+       splitting it into horizontal strips labeled in parallel threads. 
+       Components crossing the seams between strips are merged with 
+       merge_labels. The labels are numbered differently from a single 
+       pass, the components are the same.
+    
+    Keyword arguments:
+    mask -- 2D boolean array
+    strips -- number of strips
+    executor -- concurrent.futures executor that labels the strips
+    """
+    labels = numpy.empty(mask.shape, dtype=numpy.int32)
+    edges = numpy.linspace(0, len(mask), strips + 1).astype(int)
+    bands = [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if (b > a)]
+    
+    def label(band):
+        return scipy.ndimage.label(mask[band[0]:band[1]], output=labels[band[0]:band[1]])
+    counts = list(executor.map(label, bands))
+    
+    # give every strip its own range of labels
+    offsets = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]])
+    
+    def shift(k):
+        strip = labels[bands[k][0]:bands[k][1]]
+        numpy.add(strip, offsets[k], out=strip, where=strip > 0)
+    list(executor.map(shift, range(len(bands))))
+    
+    # labels touching across each seam belong together
+    pairs = []
+    for top, bottom in bands[1:]:
+        above = labels[top - 1]
+        below = labels[top]
+        touching = (above > 0) & (below > 0)
+        pairs.append(numpy.stack([above[touching], below[touching]], axis=1))
+    pairs = numpy.unique(numpy.concatenate(pairs), axis=0) if (len(pairs) > 0) else numpy.zeros((0, 2), dtype=int)
+    lookup, count = merge_labels(pairs, int(sum(counts)))
+    
+    def relabel(band):
+        strip = labels[band[0]:band[1]]
+        numpy.take(lookup, strip, out=strip)
+    list(executor.map(relabel, bands))
+    return labels, count
                 
+class Preprocessor():
+    """Prepares plate images for a Tracer: luminous grayscale, inverse 
+       rounding to a black and white image with dark features white, and 
+       clearing of the edge border the Tracer skips. Works in one pass over
+       uint8 data with buffers that are reused between images of the same
+       size.
+    """
+    
+    # luminance weights for R, G, B in 1/256ths, they sum to 256 so the 
+    # weighted sum of uint8 channels fits in uint16
+    weights = (77, 150, 29)
+    
+    def __init__(self, threshold=128, border=10):
+        """Preprocessor init
+        
+        Keyword arguments:
+        threshold -- luminance below which a pixel becomes white (255)
+        border -- width of the edge border that is cleared to black
+        """
+        self.threshold = threshold
+        self.border = border
+        self.shape = None
+        return
+    
+    def allocate(self, shape):
+        """Allocates the work buffers for images of this height and width
+        
+        Keyword arguments:
+        shape -- (height, width) of the images
+        """
+        self.shape = shape
+        self.luminance = numpy.empty(shape, dtype=numpy.uint16)
+        self.channel = numpy.empty(shape, dtype=numpy.uint16)
+        self.mask = numpy.empty(shape, dtype=bool)
+        self.out = numpy.empty(shape, dtype=numpy.uint8)
+        return
+    
+    def run(self, image, out=None):
+        """Returns the preprocessed image, written into out or into a buffer
+           owned by this preprocessor that is overwritten by the next run.
+        
+        Keyword arguments:
+        image -- uint8 grayscale (height, width) or RGB(A) (height, width, 3+)
+                 image
+        out -- optional uint8 (height, width) array to write into
+        """
+        image = numpy.asarray(image)
+        shape = image.shape[:2]
+        if (self.shape != shape):
+            self.allocate(shape)
+        if (out is None):
+            out = self.out
+        
+        # luminance * 256, or the gray value * 256 for grayscale input
+        if (image.ndim == 2):
+            numpy.multiply(image, 256, out=self.luminance, dtype=numpy.uint16)
+        else:
+            numpy.multiply(image[:, :, 0], self.weights[0], out=self.luminance, dtype=numpy.uint16)
+            for c in (1, 2):
+                numpy.multiply(image[:, :, c], self.weights[c], out=self.channel, dtype=numpy.uint16)
+                numpy.add(self.luminance, self.channel, out=self.luminance)
+        
+        # inverse rounding: dark pixels become white, light ones black
+        numpy.less(self.luminance, self.threshold * 256, out=self.mask)
+        numpy.multiply(self.mask, 255, out=out, dtype=numpy.uint8)
+        
+        # clear the edge border
+        b = self.border
+        if (b > 0):
+            out[:b] = 0
+            out[-b:] = 0
+            out[:, :b] = 0
+            out[:, -b:] = 0
+        return out
+    
+class Components():
+    """Interior components of an image labeled by Tracer.label_components, 
+       with the seeds the raster scan starts clusters from. Kept so the 
+       image can be filtered again without labeling it again.
+    """
+    __slots__ = ('labels', 'count', 'top', 'boxes', 'bounds', 'flat', 'foreground', 
+                 'seeds', 'rim', 'members', 'starts')
+    
+    def __init__(self, labels, count, top):
+        """Components init
+        
+        Keyword arguments:
+        labels -- component labels of the interior, from column 11 on
+        count -- number of components
+        top -- image row of the first row of labels
+        """
+        self.labels = labels
+        self.count = count
+        self.top = top
+        self.boxes = scipy.ndimage.find_objects(labels) if (count > 0) else []
+        
+        # (count, 4) image [top, bottom, left, right] of every component
+        slices = numpy.array([(rows.start, rows.stop, cols.start, cols.stop) 
+                              for rows, cols in self.boxes], dtype=numpy.int64).reshape(-1, 4)
+        self.bounds = slices + [top, top - 1, 11, 10]
+        self.flat = labels.ravel()
+        self.foreground = numpy.flatnonzero(self.flat)
+        self.seeds = []         # heap of (pos, x, y, label) seeds
+        self.rim = 0            # number of seeds on row or column 10
+        self.members = None     # component pixels grouped by label
+        self.starts = None
+        return
+    
+    def pixels(self, label):
+        """Returns the flat positions (into labels) of the pixels of one 
+           component in raster order
+        
+        Keyword arguments:
+        label -- component label
+        """
+        if (self.members is None):
+            order = numpy.argsort(self.flat[self.foreground], kind='stable')
+            self.members = self.foreground[order]
+            self.starts = numpy.searchsorted(self.flat[self.members], 
+                                             numpy.arange(self.count + 2))
+        return self.members[self.starts[label]:self.starts[label + 1]]
+    
 class Tracer():
     """Finds, analyzes, and either accepts or rejects clusters of like pixels
        in an image and extracts them.
@@ -109,45 +620,160 @@ class Tracer():
     #visited = []           # array same size as image to mark visited pixels
     take_snapshot = False;  # flag for saving snapshot
     
-    def __init__(self, image, area_min, area_max, max_mid_distance):
-        """Tracer init
+    def __init__(self, image, area_min, area_max, max_mid_distance, engine='flood', 
+                 capture=None, rows=None, metrics=None, coarse=0, backend=None, threads=1, 
+                 roi=None):
+        """Tracer init, analyzes the image right away unless it is None
         
         Keyword arguments:
-        image -- the image to analyze
+        image -- the image to analyze, or None to only configure the tracer
         area_min -- the minimum area of a rect in percentage of image size (0-1)
         area_max -- the maximum area of a rect in percentage of image size (0-1) 
         max_mid_distance -- the max dist rect can be from middle row of pixels 
                             in percentage of image size (0-1)
+        engine -- 'flood' to trace clusters pixel by pixel (reference), or
+                  'label' to find them with whole image component labeling
+        capture -- snapshots.Capture that receives debug frames, snapshots
+                   are off when None
+        rows -- optional (top, bottom) band of rows to scan, which must not 
+                cut through any cluster
+        metrics -- instrument.Metrics that receives counters and timings
+        coarse -- downscale factor of a first pass that limits the scan to
+                  the rows of clusters reaching the middle rows, see 
+                  coarse_band (0 scans every row)
+        backend -- 'numba' to flood clusters with the compiled kernel, 
+                   'python' for trace, None for kernels.BACKEND
+        threads -- number of threads the label engine splits its labeling 
+                   over, see label_strips
+        roi -- optional (first, last) region of interest, see run
         """
+        if (engine not in ('flood', 'label')):
+            raise ValueError("unknown engine '%s'" % engine)
+        self.backend = kernels.choose_backend(backend)
         self.path = 'rectpics/pic_'
         self.image_count = 0
-        self.img_state = numpy.array(image)
         
-        # list of rectangles
-        self.rects = []
+        # debug frames, rendered only when a capture is attached
+        self.capture = capture
+        self.take_snapshot = capture is not None
+        
+        # counters and timers, a no-op unless metrics are given
+        self.metrics = metrics if (metrics is not None) else instrument.NULL
+        
+        self.area_min = area_min
+        self.area_max = area_max
+        
+        # max distance away from middle horizontal line
+        self.max_mid_distance = max_mid_distance
+        
+        self.engine = engine
+        self.coarse = coarse
+        self.threads = threads
+        self.executor = None    # labeling threads, started on first use
+        
+        # work buffers (visited array, rect store, flood stack) for each 
+        # image shape
+        self.pool = {}
+        
+        if (image is not None):
+            self.run(image, rows, roi)
+        return
+    
+    def run(self, image, rows=None, roi=None):
+        """Analyzes an image and returns the store of accepted rects. The 
+           work buffers are reused by the next run on an image of the same 
+           size, so the results are only valid until then.
+        
+        Keyword arguments:
+        image -- the image to analyze
+        rows -- optional (top, bottom) band of rows to scan, which must not 
+                cut through any cluster
+        roi -- optional (first, last) rows every accepted rect must reach 
+               into, for example UnchainedSOM.crop_rows. Only the clusters
+               that can reach them are traced, found with coarse_band.
+        """
+        self.img_state = image
+        self.background = None
+        self.interior = None    # interior components, labeled when needed
+        self.components = None  # label engine components, see rerun
+        if (self.take_snapshot):
+            self.plate = self.capture.begin()
         
         # store image in class variable
         self.img = image
+        self.img_array = numpy.asarray(image)
         self.width = len(self.img[0])
         self.height = len(self.img)
         
+        # list of rectangles and visited pixels, cleared in place
+        shape = (self.height, self.width)
+        if (shape not in self.pool):
+            stack = None
+            if (self.backend == 'numba'):
+                stack = numpy.empty(self.height * self.width, dtype=numpy.int64)
+            self.pool[shape] = (numpy.zeros(shape, dtype=numpy.uint8), 
+                                RectStore(self.width, self.height), stack)
+            fresh = True
+        else:
+            fresh = False
+        self.visited, self.rects, self.stack = self.pool[shape]
+        self.rects.clear()
+        if (self.engine == 'flood' and not fresh):
+            self.visited[...] = 0
+        
          # total area of the image
         self.img_area = len(image) * len(image[0])
         
         # min and max sizes of rectangles
-        self.min_size = area_min * self.img_area
-        self.max_size = area_max * self.img_area
-        
-        # max distance away from middle horizontal line
-        self.max_mid_distance = max_mid_distance
-        
-        self.visited = numpy.zeros_like(self.img)
+        self.min_size = self.area_min * self.img_area
+        self.max_size = self.area_max * self.img_area
 
         # middle y position of image
         self.mid_y = len(image) / 2
         
-        # for each row of pixels (exluding 5 pixels on the edges)
-        for y in range(10, len(image) - 10):
+        # rows to scan (exluding 10 pixels on the edges)
+        self.top = 10
+        self.bottom = self.height - 10
+        if (rows is not None):
+            self.top = max(self.top, rows[0])
+            self.bottom = min(self.bottom, rows[1])
+        
+        # skip the rows whose clusters cannot be accepted
+        self.roi = roi
+        self.pruned = self.coarse > 0 or roi is not None
+        if (self.pruned):
+            start = time.perf_counter()
+            band = coarse_band(image, self.max_mid_distance, self.coarse or 4, roi)
+            if (self.metrics.enabled):
+                self.metrics.add_time('tracer.coarse', time.perf_counter() - start)
+                self.metrics.count('tracer.rows_pruned', 
+                                   max(self.bottom - self.top, 0) - max(band[1] - band[0], 0))
+            self.top = max(self.top, band[0])
+            self.bottom = min(self.bottom, band[1])
+        
+        start = time.perf_counter()
+        if (self.engine == 'flood'):
+            self.flood_clusters()
+        else:
+            self.label_clusters()
+        if (self.metrics.enabled):
+            self.metrics.add_time('tracer.scan', time.perf_counter() - start)
+            self.metrics.count('tracer.runs')
+            self.metrics.count('tracer.rects_accepted', self.rects.count)
+            
+        # check for save state
+        if (self.take_snapshot):
+            self.save_state() 
+            self.capture.end(self.plate)
+        self.metrics.report('tracer')
+        return self.rects
+    
+    def flood_clusters(self):
+        """Scans the image pixel by pixel and traces every new cluster"""
+        image = self.img
+        
+        # for each row of pixels in the scanned band
+        for y in range(self.top, self.bottom):
             # for each column of pixles (excluding 10 pixels on the edges)
             for x in range(10, len(image[0]) - 10):
                     # if the pixel is not black                    
@@ -156,28 +782,236 @@ class Tracer():
                         if (self.visited[y][x] == 1):
                             continue
                         
-                        # always create the first rect
-                        if (len(self.rects) == 0):
+                        # check if point already belongs to a rect
+                        # before creating one
+                        if (not self.rects.contains(x, y)):
                             new_rectangle = Rect(y, y, x, x)
-                            self.rects.append(new_rectangle)
+                            self.rects.append(new_rectangle, y * self.width + x)
+                            self.metrics.count('tracer.rects_created')
                             self.trace(new_rectangle, x, y)
                             self.reject_rect(new_rectangle)
-                        else:
-                            # check if point already belongs to a rect
-                            # before creating one
-                            in_rect = False
-                            for r in self.rects:
-                                if (r.contains(x, y)):
-                                    in_rect = True
-                                    break
-                            if (not in_rect):
-                                new_rectangle = Rect(y, y, x, x)
-                                self.rects.append(new_rectangle)
-                                self.trace(new_rectangle, x, y)
-                                self.reject_rect(new_rectangle)
-        # check for save state
-        if (self.take_snapshot):
-            self.save_state() 
+                            
+        if (self.metrics.enabled):
+            self.metrics.count('tracer.pixels_visited', 
+                               int(numpy.count_nonzero(self.visited[self.top:self.bottom])))
+        return
+    
+    def label_clusters(self):
+        """Finds clusters with whole image component labeling and computes
+           their bounding boxes in bulk. Produces the same rects, in the same
+           order, as flood_clusters.
+           
+           The flood can move freely between pixels in rows and columns
+           11 to size-11, but can never step back onto row or column 10 (the
+           first scanned ones). Those interior components are labeled in one
+           pass; the few foreground pixels on row and column 10 are traced
+           by hand. Clusters are then visited in the order the raster scan
+           would first reach an uncovered pixel of them.
+        """
+        self.components = self.label_components()
+        if (self.components is not None):
+            self.replay(self.components)
+        return
+    
+    def label_components(self):
+        """Labels the interior components of the scanned band and collects 
+           the seeds the raster scan starts clusters from. Returns them as 
+           Components, or None when there is nothing to scan.
+        """
+        img = numpy.asarray(self.img)
+        width = self.width
+        if (self.bottom <= self.top or width <= 20):
+            return None
+        
+        # 4-connected components of the interior region of the band
+        top = max(self.top, 11)
+        self.label_top = top
+        labels, count = self.label_interior(img[top:self.bottom, 11:width-10] != 0)
+        self.metrics.count('tracer.components', int(count))
+        components = Components(labels, count, top)
+        
+        # raster position of the first pixel of every component
+        foreground = components.foreground
+        self.metrics.count('tracer.pixels_visited', len(foreground))
+        firsts = numpy.unique(components.flat[foreground], return_index=True)[1]
+        first_pos = foreground[firsts]
+        inner_width = labels.shape[1]
+        first_y = first_pos // inner_width + top
+        first_x = first_pos % inner_width + 11
+        
+        # candidate seeds ordered by raster position: (pos, x, y, label)
+        # a label of 0 marks a seed on row or column 10
+        seeds = [(int(y * width + x), int(x), int(y), int(n + 1))
+                 for n, (x, y) in enumerate(zip(first_x, first_y))]
+        if (self.top == 10):
+            for x in numpy.flatnonzero(img[10, 10:width-10]) + 10:
+                seeds.append((int(10 * width + x), int(x), 10, 0))
+        for y in numpy.flatnonzero(img[top:self.bottom, 10]) + top:
+            seeds.append((int(y * width + 10), 10, int(y), 0))
+        heapq.heapify(seeds)
+        components.seeds = seeds
+        components.rim = len(seeds) - len(first_pos)
+        return components
+    
+    def replay(self, components):
+        """Visits the clusters of labeled components in raster scan order,
+           accepting or rejecting each with the current thresholds
+        
+        Keyword arguments:
+        components -- Components from label_components
+        """
+        width = self.width
+        top = components.top
+        labels = components.labels
+        boxes = components.boxes
+        inner_width = labels.shape[1]
+        done = numpy.zeros(components.count + 1, dtype=bool)
+        
+        # a component seeded on its own always becomes its bounding box, so
+        # the ones whose box would be rejected can be left out, as they
+        # would not cover anything. Only without rim seeds though, as a rim
+        # trace takes in the components that were not seeded before it.
+        if (components.rim == 0):
+            ok = self.accepts(components.bounds)
+            seeds = [seed for seed in components.seeds if (ok[seed[3] - 1])]
+            heapq.heapify(seeds)
+        else:
+            seeds = list(components.seeds)
+        rim_visited = set()
+        while (len(seeds) > 0):
+            pos, x, y, label = heapq.heappop(seeds)
+            if (label == 0 and (x, y) in rim_visited):
+                continue
+            if (label > 0 and done[label]):
+                continue
+            
+            # skip points that already belong to a rect
+            if (self.rects.contains(x, y)):
+                if (label > 0):
+                    # the scan reaches this cluster again at its next pixel
+                    # outside all rects accepted so far
+                    pixels = components.pixels(label)
+                    ys = pixels // inner_width + top
+                    xs = pixels % inner_width + 11
+                    later = ys * width + xs > pos
+                    ys = ys[later]
+                    xs = xs[later]
+                    remaining = numpy.flatnonzero(self.rects.coverage[ys, xs] == 0)
+                    if (len(remaining) > 0):
+                        nx = int(xs[remaining[0]])
+                        ny = int(ys[remaining[0]])
+                        heapq.heappush(seeds, (ny * width + nx, nx, ny, label))
+                continue
+            
+            new_rectangle = Rect(y, y, x, x)
+            self.rects.append(new_rectangle, pos)
+            self.metrics.count('tracer.rects_created')
+            if (label > 0):
+                self.add_component(new_rectangle, boxes, label, done)
+            else:
+                self.trace_rim(new_rectangle, x, y, labels, boxes, done, rim_visited)
+            self.reject_rect(new_rectangle)
+        return
+    
+    def rerun(self, area_min, area_max, max_mid_distance):
+        """Filters the clusters of the last image again with other 
+           thresholds and returns the store of accepted rects. The 
+           component labeling of the last run is reused, only the raster 
+           order replay and the accept or reject checks are repeated. Needs 
+           a label engine run that scanned every row.
+        
+        Keyword arguments:
+        area_min -- the minimum area of a rect in percentage of image size (0-1)
+        area_max -- the maximum area of a rect in percentage of image size (0-1) 
+        max_mid_distance -- the max dist rect can be from middle row of pixels 
+                            in percentage of image size (0-1)
+        """
+        if (self.engine != 'label' or self.pruned):
+            raise ValueError('rerun needs a label engine run without a coarse pass or roi')
+        self.area_min = area_min
+        self.area_max = area_max
+        self.max_mid_distance = max_mid_distance
+        self.min_size = self.area_min * self.img_area
+        self.max_size = self.area_max * self.img_area
+        
+        self.rects.clear()
+        if (self.components is not None):
+            self.replay(self.components)
+        self.metrics.count('tracer.reruns')
+        return self.rects
+    
+    def label_interior(self, mask):
+        """Returns the labels and count of the 4-connected components of a 
+           mask, labeled in strips by several threads if configured
+        
+        Keyword arguments:
+        mask -- 2D boolean array
+        """
+        # strips thinner than this are not worth a thread
+        strips = min(self.threads, len(mask) // 64)
+        if (strips <= 1):
+            return scipy.ndimage.label(mask)
+        if (self.executor is None):
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        start = time.perf_counter()
+        labels, count = label_strips(mask, strips, self.executor)
+        self.metrics.add_time('tracer.label_strips', time.perf_counter() - start)
+        return labels, count
+    
+    def add_component(self, r, boxes, label, done):
+        """Expands a rect to hold a labeled interior component
+        
+        Keyword arguments:
+        r -- rectangle to expand
+        boxes -- component slices from scipy.ndimage.find_objects
+        label -- component label
+        done -- per label flags of components already traced
+        """
+        rows, cols = boxes[label - 1]
+        r.add(cols.start + 11, rows.start + self.label_top)
+        r.add(cols.stop + 10, rows.stop - 1 + self.label_top)
+        done[label] = True
+        return
+    
+    def trace_rim(self, r, x, y, labels, boxes, done, rim_visited):
+        """Traces a cluster seeded on row or column 10 with the same one way
+           moves as trace, taking in whole interior components it enters.
+        
+        Keyword arguments:
+        r -- rectangle object to create
+        x -- point x position to start trace
+        y -- point y position to start trace
+        labels -- interior component labels
+        boxes -- component slices from scipy.ndimage.find_objects
+        done -- per label flags of components already traced
+        rim_visited -- set of row and column 10 points already visited
+        """
+        to_visit = [(x, y)]
+        while (len(to_visit) > 0):
+            px, py = to_visit.pop()
+            if (py < self.top or py >= self.bottom):
+                # outside the scanned band
+                continue
+            if (px > 10 and py > 10):
+                # stepped into the interior
+                label = labels[py - self.label_top][px - 11]
+                if (label > 0 and not done[label]):
+                    self.add_component(r, boxes, label, done)
+                continue
+            if ((px, py) in rim_visited):
+                continue
+            rim_visited.add((px, py))
+            if (self.img[py][px] == 0):
+                continue
+            r.add(px, py)
+            if (px + 1 < self.width - 10):
+                to_visit.append((px + 1, py))
+            if (px - 1 > 10):
+                to_visit.append((px - 1, py))
+            if (py + 1 < self.height - 10):
+                to_visit.append((px, py + 1))
+            if (py - 1 > 10):
+                to_visit.append((px, py - 1))
         return
     
     def trace(self, r, x, y):
@@ -188,103 +1022,235 @@ class Tracer():
         x -- point x position to start trace
         y -- point y position to start trace
         """
+        if (self.stack is not None and not self.take_snapshot):
+            self.compiled_trace(r, x, y)
+            return
+        
         snap = 0 # snap value for save state
+        interval = self.capture.interval if (self.take_snapshot) else 0
+        
+        # stack depth, only tracked with metrics
+        track = self.metrics.enabled
+        flooded = 0
+        depth = 0
         
-        to_visit = []   #list of points to visit
-        to_visit.append(Point(x, y))
+        to_visit = []   #list of (x, y) points to visit
+        to_visit.append((x, y))
         
         while (len(to_visit) > 0):
-            pixel = to_visit.pop()
-            self.visited[pixel.y][pixel.x] = 1
+            px, py = to_visit.pop()
+            self.visited[py][px] = 1
                 
-            if (self.img[pixel.y][pixel.x] != 0):                
-                r.add(pixel.x, pixel.y)
+            if (self.img[py][px] != 0):                
+                r.add(px, py)
+                flooded += 1
                 
-                snap += 1
-                if (snap % 100 == 0):
-                    self.save_state()
+                if (interval):
+                    snap += 1
+                    if (snap % interval == 0):
+                        self.save_state()
                     
-                if (pixel.x+1 < self.width-10 and self.visited[pixel.y][pixel.x+1] == 0):
-                    to_visit.append(Point(pixel.x+1, pixel.y))
-                if (pixel.x-1 > 10 and self.visited[pixel.y][pixel.x-1] == 0):
-                    to_visit.append(Point(pixel.x-1, pixel.y))
-                if (pixel.y+1 < self.height-10 and self.visited[pixel.y+1][pixel.x] == 0):
-                    to_visit.append(Point(pixel.x, pixel.y+1))
-                if (pixel.y-1 > 10 and self.visited[pixel.y-1][pixel.x] == 0):
-                    to_visit.append(Point(pixel.x, pixel.y-1))
+                if (px+1 < self.width-10 and self.visited[py][px+1] == 0):
+                    to_visit.append((px+1, py))
+                if (px-1 > 10 and self.visited[py][px-1] == 0):
+                    to_visit.append((px-1, py))
+                if (py+1 < self.height-10 and self.visited[py+1][px] == 0):
+                    to_visit.append((px, py+1))
+                if (py-1 > 10 and self.visited[py-1][px] == 0):
+                    to_visit.append((px, py-1))
+                    
+                if (track and len(to_visit) > depth):
+                    depth = len(to_visit)
+                
+                # a rect only grows, once it is too large the cluster is
+                # rejected whatever is left of it
+                if (flooded % 64 == 0 and r.area > self.max_size):
+                    self.abandon(to_visit)
+                    self.metrics.count('tracer.clusters_abandoned')
+                    break
+        
+        if (track):
+            self.metrics.count('tracer.pixels_flooded', flooded)
+            self.metrics.maximum('tracer.largest_cluster', flooded)
+            self.metrics.maximum('tracer.stack_depth', depth)
         
         # check for save state
         if (self.take_snapshot):
             self.save_state()
         return
     
+    def compiled_trace(self, r, x, y):
+        """Traces a single cluster with the compiled flood kernel, see 
+           kernels.flood
+        
+        Keyword arguments:
+        r -- rectangle object to create
+        x -- point x position to start trace
+        y -- point y position to start trace
+        """
+        top, bottom, left, right, flooded, depth, abandoned = kernels.flood(
+            self.img_array, self.visited, self.stack, x, y, self.max_size)
+        r.add(left, top)
+        r.add(right, bottom)
+        
+        if (self.metrics.enabled):
+            self.metrics.count('tracer.pixels_flooded', int(flooded))
+            self.metrics.maximum('tracer.largest_cluster', int(flooded))
+            self.metrics.maximum('tracer.stack_depth', int(depth))
+            if (abandoned):
+                self.metrics.count('tracer.clusters_abandoned')
+        return
+    
+    def abandon(self, to_visit):
+        """Marks the rest of a cluster that is too large as visited without
+           tracing it. Every pixel of an interior component is marked at once
+           from the components labeled on first use; points on row or column
+           10 are still stepped through one at a time.
+        
+        Keyword arguments:
+        to_visit -- the points left to visit by trace
+        """
+        if (self.interior is None):
+            img = numpy.asarray(self.img)
+            labels, count = scipy.ndimage.label(img[11:self.height-10, 11:self.width-10] != 0)
+            boxes = scipy.ndimage.find_objects(labels) if (count > 0) else []
+            self.interior = (labels, boxes)
+        labels, boxes = self.interior
+        
+        while (len(to_visit) > 0):
+            px, py = to_visit.pop()
+            if (self.visited[py][px] == 1):
+                continue
+            if (px > 10 and py > 10):
+                label = labels[py - 11][px - 11]
+                if (label == 0):
+                    self.visited[py][px] = 1
+                else:
+                    # the flood would reach exactly this component
+                    rows, cols = boxes[label - 1]
+                    area = self.visited[rows.start + 11:rows.stop + 11, 
+                                        cols.start + 11:cols.stop + 11]
+                    area[labels[rows, cols] == label] = 1
+                continue
+            self.visited[py][px] = 1
+            if (self.img[py][px] != 0):
+                if (px+1 < self.width-10 and self.visited[py][px+1] == 0):
+                    to_visit.append((px+1, py))
+                if (px-1 > 10 and self.visited[py][px-1] == 0):
+                    to_visit.append((px-1, py))
+                if (py+1 < self.height-10 and self.visited[py+1][px] == 0):
+                    to_visit.append((px, py+1))
+                if (py-1 > 10 and self.visited[py-1][px] == 0):
+                    to_visit.append((px, py-1))
+        return
+    
+    def accepts(self, bounds):
+        """Returns a mask of the rects reject_rect would accept
+        
+        Keyword arguments:
+        bounds -- (n, 4) array of [top, bottom, left, right]
+        """
+        top, bottom, left, right = bounds.T
+        area = (bottom - top + 1) * (right - left + 1)
+        ok = ((area >= self.min_size) & (area <= self.max_size) & 
+              (top - self.mid_y <= self.max_mid_distance * self.mid_y) & 
+              (self.mid_y - bottom <= self.max_mid_distance * self.mid_y))
+        if (self.roi is not None):
+            ok &= (bottom >= self.roi[0]) & (top <= self.roi[1])
+        return ok
+    
     def reject_rect(self, rect):
-        """Analyze and remove rect from list if neccessary
+        """Analyze and remove rect from list if neccessary, otherwise accept
+           it into the rect store. Returns the reason for a rejection, or 
+           None when the rect was accepted.
         
         Keyword arguments:
         rect -- The rectangle to be analyzed
         """
-        if (rect.area < self.min_size):
-            self.rects.remove(rect)
-        elif (rect.area > self.max_size):
-            self.rects.remove(rect)
+        area = rect.area
+        reason = None
+        if (area < self.min_size):
+            reason = 'too_small'
+        elif (area > self.max_size):
+            reason = 'too_large'
         elif (rect.top - self.mid_y > self.max_mid_distance * self.mid_y):
-            self.rects.remove(rect)
+            reason = 'below_mid'
         elif (self.mid_y - rect.bottom > self.max_mid_distance * self.mid_y):
-            self.rects.remove(rect)
-        return
+            reason = 'above_mid'
+        elif (self.roi is not None and (rect.bottom < self.roi[0] or rect.top > self.roi[1])):
+            reason = 'outside_roi'
+            
+        if (reason is None):
+            self.rects.accept(rect)
+        else:
+            self.rects.reject(rect)
+            if (self.metrics.enabled):
+                self.metrics.count('tracer.rects_rejected')
+                self.metrics.count('tracer.rects_rejected.' + reason)
+                self.metrics.maximum('tracer.largest_rejected_area', int(area))
+        return reason
     
     def highlight_rects(self):
         """Creates a new image that darkens background image and draws all 
            existing rectangles in white.
         """
-        highlighted_image = filters.darken(numpy.array(self.img), 2)
-        for r in self.rects:
-            for x in range (r.left, r.right):
-                highlighted_image[r.top][x] = 255
-                highlighted_image[r.bottom][x] = 255
-            for y in range (r.top + 1, r.bottom - 1):
-                highlighted_image[y][r.left] = 255
-                highlighted_image[y][r.right] = 255
-        return highlighted_image
+        highlighted_image = render.darken(self.img, 2)
+        return render.draw_rects(highlighted_image, self.rects.as_array())
         
     def extract_rects(self, original):
         """Extracts sub images based on rectangle coordinates.
-           Returns a sorted list of these images ordered top-down, left-right
+           Returns a list of read only views of these images ordered left to
+           right
         """
-        images = []     # list of images cut out from origin
+        return extract_rects(self.rects, original)
         
-        new_rects = []
-        for r in self.rects:
-            new_rects.append([r.left,r.right,r.top,r.bottom])
-            
-        #sort rects before slicing
-        new_rects = numpy.sort(new_rects, axis=0)
+    def pack_rects(self, original, out=None):
+        """Packs the sub images into one buffer, see pack_rects"""
+        return pack_rects(self.rects, original, out)
         
-        #slice images and place them in the array                    
-        for r in new_rects:
-            image = numpy.array(original[r[2]:r[3], r[0]:r[1]])
-            images.append(image)
-        return images
+    def resample_rects(self, original, height, width):
+        """Returns the sub images resampled to one size, see resample_rects"""
+        return resample_rects(self.rects, original, height, width)
         
     def save_state(self):
-        """Saves an image to the path specificed containing a darkened image
-           with rectangles and their contents highlighted
-        """
-        state = filters.darken(numpy.array(self.img), 2)
-        for r in self.rects:
-            for x in range (r.left, r.right):
-                state[r.top][x] = 255
-                state[r.bottom][x] = 255
-            for y in range (r.top + 1, r.bottom - 1):
-                state[y][r.left] = 255
-                state[y][r.right] = 255
-            for x in range (r.left, r.right):
-                for y in range (r.top+1, r.bottom - 1):
-                    if (self.img[y][x] != 0):
-                        state[y][x] = 255
-            
-        scipy.misc.imsave(self.path + str(self.image_count) + '.jpg', state)
+        """Renders a darkened image with rectangles and their contents 
+           highlighted and hands it to the capture. Without a capture the 
+           frame is written straight to the path specified.
+        """
+        start = time.perf_counter()
+        if (self.background is None):
+            self.background = render.darken(self.img, 2)
+        state = render.render_rects(self.background, self.img_array, self.rects.as_array())
+        
+        if (self.capture is not None):
+            self.capture.add(self.plate, state)
+        else:
+            snapshots.write_frames(self.path + str(self.image_count), [state], 'npz')
         self.image_count += 1
+        self.metrics.add_time('tracer.snapshot', time.perf_counter() - start)
+        return
+
+class Segmenter(Tracer):
+    """A Tracer that is configured once and then run on many images, for 
+       example one per worker thread.
+    """
+    
+    def __init__(self, area_min, area_max, max_mid_distance, engine='label', 
+                 capture=None, metrics=None, coarse=0, backend=None, threads=1):
+        """Segmenter init
+        
+        Keyword arguments:
+        area_min -- the minimum area of a rect in percentage of image size (0-1)
+        area_max -- the maximum area of a rect in percentage of image size (0-1) 
+        max_mid_distance -- the max dist rect can be from middle row of pixels 
+                            in percentage of image size (0-1)
+        engine -- 'flood' or 'label', see Tracer
+        capture -- snapshots.Capture that receives debug frames
+        metrics -- instrument.Metrics that receives counters and timings
+        coarse -- downscale factor of the coarse pass, see Tracer
+        backend -- flood backend, see Tracer
+        threads -- labeling threads, see Tracer
+        """
+        Tracer.__init__(self, None, area_min, area_max, max_mid_distance, engine, capture, 
+                        metrics=metrics, coarse=coarse, backend=backend, threads=threads)
         return
-        
\ No newline at end of file
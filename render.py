@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized drawing of the debug and QA overlays of Tracer and UnchainedSOM.
+
+Every function takes plain arrays (rect bounds as an (n, 4) array of
+[top, bottom, left, right], neuron positions as an (n, 2) array of x, y)
+and draws all of them with a few fancy index writes into a frame, without
+touching the objects they came from.
+"""
+
+import numpy
+
+
+def darken(image, contrast):
+    """Returns a copy of image with every intensity divided by contrast, of
+       the same type, as the background the overlays are drawn on
+
+    Keyword arguments:
+    image -- 2D image array
+    contrast -- factor the intensities are divided by
+    """
+    image = numpy.asarray(image)
+    if (numpy.issubdtype(image.dtype, numpy.integer)):
+        return (image // contrast).astype(image.dtype)
+    return image / contrast
+
+
+def spans(starts, lengths):
+    """Returns the ranges start..start+length-1 of every pair, concatenated
+
+    Keyword arguments:
+    starts -- (n,) first value of each range
+    lengths -- (n,) length of each range, negative lengths are empty
+    """
+    lengths = numpy.maximum(lengths, 0)
+    ends = numpy.cumsum(lengths)
+    total = ends[-1] if (len(ends) > 0) else 0
+    return numpy.repeat(starts - ends + lengths, lengths) + numpy.arange(total)
+
+
+def outline_pixels(bounds):
+    """Returns the rows and columns of the outlines of rects: the top and
+       bottom edges from left to right-1, the left and right edges from
+       top+1 to bottom-2.
+
+    Keyword arguments:
+    bounds -- (n, 4) array of [top, bottom, left, right]
+    """
+    bounds = numpy.asarray(bounds, dtype=numpy.int64).reshape(-1, 4)
+    top, bottom, left, right = bounds.T
+    widths = numpy.maximum(right - left, 0)
+    heights = numpy.maximum(bottom - top - 2, 0)
+
+    across = spans(left, widths)
+    down = spans(top + 1, heights)
+    rows = numpy.concatenate([numpy.repeat(top, widths), numpy.repeat(bottom, widths),
+                              down, down])
+    cols = numpy.concatenate([across, across, numpy.repeat(left, heights),
+                              numpy.repeat(right, heights)])
+    return rows, cols
+
+
+def interior_mask(shape, bounds):
+    """Returns a boolean mask of the pixels inside rects, rows top+1 to
+       bottom-2 and columns left to right-1, built from a 2D difference
+       array in one pass.
+
+    Keyword arguments:
+    shape -- (height, width) of the mask
+    bounds -- (n, 4) array of [top, bottom, left, right]
+    """
+    bounds = numpy.asarray(bounds, dtype=numpy.int64).reshape(-1, 4)
+    top, bottom, left, right = bounds.T
+    keep = (top + 1 < bottom - 1) & (left < right)
+    r0 = top[keep] + 1
+    r1 = bottom[keep] - 1
+    c0 = left[keep]
+    c1 = right[keep]
+
+    diff = numpy.zeros((shape[0] + 1, shape[1] + 1), dtype=numpy.int32)
+    numpy.add.at(diff, (r0, c0), 1)
+    numpy.add.at(diff, (r0, c1), -1)
+    numpy.add.at(diff, (r1, c0), -1)
+    numpy.add.at(diff, (r1, c1), 1)
+    numpy.cumsum(diff, axis=0, out=diff)
+    numpy.cumsum(diff, axis=1, out=diff)
+    return diff[:shape[0], :shape[1]] > 0
+
+
+def draw_rects(frame, bounds, value=255):
+    """Draws the outline of every rect into frame and returns it
+
+    Keyword arguments:
+    frame -- 2D array drawn into
+    bounds -- (n, 4) array of [top, bottom, left, right]
+    value -- outline intensity
+    """
+    rows, cols = outline_pixels(bounds)
+    frame[rows, cols] = value
+    return frame
+
+
+def fill_rects(frame, image, bounds, value=255):
+    """Sets the pixels inside rects that are not background in image
+
+    Keyword arguments:
+    frame -- 2D array drawn into
+    image -- image the rects were found in
+    bounds -- (n, 4) array of [top, bottom, left, right]
+    value -- fill intensity
+    """
+    inside = interior_mask(frame.shape, bounds)
+    inside &= numpy.asarray(image) != 0
+    frame[inside] = value
+    return frame
+
+
+def draw_markers(frame, positions, size, value):
+    """Draws a size x size square for every position, starting one pixel
+       above and to the left of it, clipped to the frame
+
+    Keyword arguments:
+    frame -- 2D array drawn into
+    positions -- (n, 2) integer array of x, y positions
+    size -- side of the squares
+    value -- marker intensity
+    """
+    positions = numpy.asarray(positions, dtype=numpy.int64).reshape(-1, 2)
+    offsets = numpy.arange(size) - 1
+    xs = positions[:, 0, None, None] + offsets[None, None, :]
+    ys = positions[:, 1, None, None] + offsets[None, :, None]
+    xs, ys = numpy.broadcast_arrays(xs, ys)
+    valid = (xs >= 0) & (xs < frame.shape[1]) & (ys >= 0) & (ys < frame.shape[0])
+    frame[ys[valid], xs[valid]] = value
+    return frame
+
+
+def render_rects(background, image, bounds, out=None):
+    """Returns a copy of background with every rect outlined and the pixels
+       of image inside them set, as in Tracer.save_state
+
+    Keyword arguments:
+    background -- darkened image to draw over
+    image -- image the rects were found in
+    bounds -- (n, 4) array of [top, bottom, left, right]
+    out -- optional preallocated frame of the same shape and type
+    """
+    if (out is None):
+        out = numpy.array(background)
+    else:
+        numpy.copyto(out, background)
+    draw_rects(out, bounds)
+    fill_rects(out, image, bounds)
+    return out
+
+
+def render_neurons(background, weights, size, value, out=None):
+    """Returns a copy of background with a marker on every neuron, at its
+       rounded position, as in UnchainedSOM.highlight_neurons
+
+    Keyword arguments:
+    background -- darkened image to draw over
+    weights -- (n, 2) array of neuron x, y positions, left unchanged
+    size -- side of the markers
+    value -- marker intensity
+    out -- optional preallocated frame of the same shape and type
+    """
+    if (out is None):
+        out = numpy.array(background)
+    else:
+        numpy.copyto(out, background)
+    positions = numpy.round(weights).astype(int)
+    return draw_markers(out, positions, size, value)
@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio front end for plate segmentation.
+
+Producers (camera handlers, web requests, ...) await segment() on one
+shared SegmentationService. Requests wait in a bounded queue, so producers
+slow down when the workers fall behind. They are grouped into micro batches
+of plates of the same shape and run by a pool of worker threads, each with
+its own warmed up Segmenter. Every request may carry a deadline after which
+it fails with DeadlineExceeded instead of being segmented.
+
+Run as a script to try it with synthetic producers, for example
+
+    python service.py --producers 8 --plates 200 --timeout 0.5
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+
+import numpy
+
+import rectfinder
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """A request was not segmented before its deadline"""
+
+
+class SegmentationService():
+    """Segments plates from many concurrent producers in micro batches"""
+
+    def __init__(self, area_min, area_max, max_mid_distance, engine='label', workers=4,
+                 max_queue=256, max_batch=16, max_delay=0.005, history=1000):
+        """SegmentationService init, call start() from a running event loop
+           before segmenting
+
+        Keyword arguments:
+        area_min -- the minimum area of a rect in percentage of image size (0-1)
+        area_max -- the maximum area of a rect in percentage of image size (0-1)
+        max_mid_distance -- the max dist rect can be from middle row of pixels
+                            in percentage of image size (0-1)
+        engine -- Tracer engine used by the workers
+        workers -- number of worker threads
+        max_queue -- requests waiting before producers are held up
+        max_batch -- most plates in one micro batch
+        max_delay -- seconds a batch waits for more plates once it has one
+        history -- number of recent requests the latency statistics cover
+        """
+        self.config = (area_min, area_max, max_mid_distance, engine)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self.queue = None
+        self.executor = None
+        self.dispatcher = None
+        self.slots = None
+        self.running = set()
+        self.closed = False
+        self.local = threading.local()
+
+        # statistics
+        self.counters = collections.Counter()
+        self.max_depth = 0
+        self.latencies = collections.deque(maxlen=history)
+        self.batch_sizes = collections.deque(maxlen=history)
+        return
+
+    async def start(self):
+        """Starts the worker threads and the dispatcher task"""
+        self.closed = False
+        self.queue = asyncio.Queue(self.max_queue)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.dispatcher = asyncio.get_running_loop().create_task(self.dispatch())
+        return
+
+    async def close(self):
+        """Finishes the batches already running, fails the requests still
+           queued and stops the workers
+        """
+        self.closed = True
+        if (self.dispatcher is not None):
+            self.dispatcher.cancel()
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            self.dispatcher = None
+        if (len(self.running) > 0):
+            await asyncio.gather(*self.running, return_exceptions=True)
+        if (self.queue is not None):
+            self.drain()
+        if (self.executor is not None):
+            self.executor.shutdown()
+            self.executor = None
+        return
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    async def segment(self, image, timeout=None):
+        """Segments a plate and returns its sub images as extract_rects
+           would. Waits while the queue is full. Raises DeadlineExceeded if
+           the plate was not segmented within timeout seconds.
+
+        Keyword arguments:
+        image -- the preprocessed plate
+        timeout -- seconds until the deadline of this request, None waits
+                   as long as it takes
+        """
+        if (self.closed):
+            raise RuntimeError('service closed')
+        if (self.dispatcher is None):
+            raise RuntimeError('service is not started')
+        loop = asyncio.get_running_loop()
+        submitted = loop.time()
+        deadline = None if (timeout is None) else submitted + timeout
+        future = loop.create_future()
+        image = numpy.asarray(image)
+        request = (image, future, deadline, submitted)
+        self.counters['submitted'] += 1
+
+        try:
+            if (deadline is None):
+                await self.queue.put(request)
+            else:
+                await asyncio.wait_for(self.queue.put(request), deadline - loop.time())
+        except asyncio.TimeoutError:
+            self.counters['expired'] += 1
+            raise DeadlineExceeded('queue full until the deadline') from None
+        if (self.closed):
+            # held up by the full queue until close() had drained it,
+            # nothing reads the queue anymore
+            self.drain()
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+        try:
+            if (deadline is None):
+                return await future
+            return await asyncio.wait_for(asyncio.shield(future), deadline - loop.time())
+        except asyncio.TimeoutError:
+            if (future.done() and not future.cancelled()):
+                # finished just as the deadline passed
+                return future.result()
+            # a worker may still finish it, but nobody is waiting
+            future.cancel()
+            self.counters['expired'] += 1
+            raise DeadlineExceeded('not segmented before the deadline') from None
+
+    async def dispatch(self):
+        """Dispatcher task: collects micro batches from the queue and runs
+           them on the workers, at most one batch per worker at a time
+        """
+        while (True):
+            # wait for a free worker before taking requests off the queue,
+            # so a full queue holds up the producers
+            await self.slots.acquire()
+            try:
+                batches = await self.collect()
+            except asyncio.CancelledError:
+                self.slots.release()
+                raise
+
+            # one batch per shape, the largest first
+            groups = sorted(batches.values(), key=len, reverse=True)
+            k = 0
+            try:
+                for k, requests in enumerate(groups):
+                    if (k > 0):
+                        await self.slots.acquire()
+                    self.launch(requests)
+            except asyncio.CancelledError:
+                self.fail(groups[k:], RuntimeError('service closed'))
+                raise
+
+    async def collect(self):
+        """Waits for a request, then gathers more for up to max_delay 
+           seconds or until there are max_batch of them. Returns them 
+           grouped by image shape.
+        """
+        loop = asyncio.get_running_loop()
+        batches = collections.OrderedDict()     # shape -> requests
+        try:
+            request = await self.queue.get()
+            batches[request[0].shape] = [request]
+            count = 1
+            end = loop.time() + self.max_delay
+            while (count < self.max_batch):
+                if (self.queue.empty()):
+                    remaining = end - loop.time()
+                    if (remaining <= 0):
+                        break
+                    try:
+                        request = await asyncio.wait_for(self.queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self.queue.get_nowait()
+                batches.setdefault(request[0].shape, []).append(request)
+                count += 1
+        except asyncio.CancelledError:
+            # requests taken off the queue still get an answer
+            self.fail(batches.values(), RuntimeError('service closed'))
+            raise
+        return batches
+
+    def drain(self):
+        """Fails every request left in the queue"""
+        while (not self.queue.empty()):
+            self.fail([[self.queue.get_nowait()]], RuntimeError('service closed'))
+        return
+
+    def fail(self, groups, error):
+        """Fails every request of some groups that is still awaited
+
+        Keyword arguments:
+        groups -- iterable of lists of requests
+        error -- exception to set
+        """
+        for requests in groups:
+            for image, future, deadline, submitted in requests:
+                if (not future.done()):
+                    future.set_exception(error)
+        return
+
+    def launch(self, requests):
+        """Drops requests past their deadline or no longer awaited and runs
+           the rest on a worker, using the worker slot acquired for them
+
+        Keyword arguments:
+        requests -- list of (image, future, deadline, submitted) of one shape
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        live = []
+        for request in requests:
+            image, future, deadline, submitted = request
+            if (future.done()):
+                continue
+            if (deadline is not None and now > deadline):
+                future.set_exception(DeadlineExceeded('deadline passed in the queue'))
+                self.counters['expired'] += 1
+                continue
+            live.append(request)
+        if (len(live) == 0):
+            self.slots.release()
+            return
+
+        self.counters['batches'] += 1
+        self.batch_sizes.append(len(live))
+        work = loop.run_in_executor(self.executor, self.run_batch,
+                                    [request[0] for request in live])
+        task = loop.create_task(self.finish(work, live))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+        return
+
+    async def finish(self, work, requests):
+        """Hands the results of a batch back to its requests
+
+        Keyword arguments:
+        work -- future of the rect tuples of every plate
+        requests -- the requests of the batch
+        """
+        try:
+            results = await work
+        except Exception as e:
+            self.fail([requests], e)
+            self.counters['failed'] += len(requests)
+            return
+        finally:
+            self.slots.release()
+
+        now = asyncio.get_running_loop().time()
+        for (image, future, deadline, submitted), rects in zip(requests, results):
+            if (future.done()):
+                continue
+            rects = [rectfinder.Rect(*r) for r in rects]
+            future.set_result(rectfinder.extract_rects(rects, image))
+            self.latencies.append(now - submitted)
+            self.counters['completed'] += 1
+        return
+
+    def run_batch(self, images):
+        """Worker side: segments plates of one shape with the segmenter of
+           this thread and returns a list of (top, bottom, left, right)
+           tuples per plate
+
+        Keyword arguments:
+        images -- list of preprocessed plates
+        """
+        segmenter = getattr(self.local, 'segmenter', None)
+        if (segmenter is None):
+            segmenter = rectfinder.Segmenter(*self.config)
+            self.local.segmenter = segmenter
+        results = []
+        for image in images:
+            rects = segmenter.run(image)
+            results.append([(r.top, r.bottom, r.left, r.right) for r in rects])
+        return results
+
+    def stats(self):
+        """Returns a dict of queue depth, request counts, batch sizes and
+           latency percentiles of the recent requests
+        """
+        latencies = numpy.asarray(self.latencies, dtype=float) * 1000
+        stats = {
+            'queue_depth': self.queue.qsize() if (self.queue is not None) else 0,
+            'max_queue_depth': self.max_depth,
+            'batches_running': len(self.running),
+            'mean_batch_size': float(numpy.mean(self.batch_sizes)) if (len(self.batch_sizes) > 0) else None,
+        }
+        for name in ('submitted', 'completed', 'expired', 'failed', 'batches'):
+            stats[name] = self.counters[name]
+        for p in (50, 90, 99):
+            stats['latency_p%d_ms' % p] = (float(numpy.percentile(latencies, p))
+                                           if (len(latencies) > 0) else None)
+        return stats
+
+
+async def produce(service, plates, timeout, results):
+    """Synthetic producer: segments its plates one after another
+
+    Keyword arguments:
+    service -- a started SegmentationService
+    plates -- list of plates to send
+    timeout -- deadline of each request in seconds, or None
+    results -- Counter of outcomes, updated in place
+    """
+    for plate in plates:
+        try:
+            await service.segment(plate, timeout)
+            results['ok'] += 1
+        except DeadlineExceeded:
+            results['expired'] += 1
+    return
+
+
+async def simulate(args):
+    """Runs synthetic producers against a service and returns its stats"""
+    # only the load test needs the benchmark plates, and with them the SOM
+    import benchmark
+
+    rng = numpy.random.default_rng(args.seed)
+    shapes = [(args.height, args.width), (args.height // 2, args.width // 2)]
+    service = SegmentationService(args.area_min, args.area_max, args.max_mid_distance,
+                                  args.engine, args.workers, args.max_queue,
+                                  args.max_batch, args.max_delay)
+    results = collections.Counter()
+    start = time.perf_counter()
+    async with service:
+        producers = []
+        for p in range(args.producers):
+            height, width = shapes[p % len(shapes)]
+            plates = [benchmark.synthetic_plate(height, width, args.chars, args.noise, rng)
+                      for i in range(args.plates)]
+            producers.append(produce(service, plates, args.timeout, results))
+        await asyncio.gather(*producers)
+        stats = service.stats()
+    stats['elapsed_s'] = time.perf_counter() - start
+    stats['producer_results'] = dict(results)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Synthetic load test of SegmentationService')
+    parser.add_argument('--producers', type=int, default=8, help='concurrent producers')
+    parser.add_argument('--plates', type=int, default=50, help='plates per producer')
+    parser.add_argument('--height', type=int, default=120, help='plate height')
+    parser.add_argument('--width', type=int, default=400, help='plate width')
+    parser.add_argument('--chars', type=int, default=7, help='characters per plate')
+    parser.add_argument('--noise', type=float, default=0.02, help='noise pixel density')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--engine', default='label', help='Tracer engine')
+    parser.add_argument('--workers', type=int, default=4, help='worker threads')
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--max-batch', type=int, default=16)
+    parser.add_argument('--max-delay', type=float, default=0.005)
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='deadline of each request in seconds')
+    parser.add_argument('--area-min', type=float, default=0.0005)
+    parser.add_argument('--area-max', type=float, default=0.2)
+    parser.add_argument('--max-mid-distance', type=float, default=0.6)
+    args = parser.parse_args(argv)
+
+    stats = asyncio.run(simulate(args))
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+if __name__ == '__main__':
+    main()
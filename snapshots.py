@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Debug frame capture for Tracer and UnchainedSOM snapshots.
+
+Frames are handed to a background writer thread through a bounded queue and
+written as one file per plate instead of one image per frame.
+"""
+
+import queue
+import threading
+import numpy
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+
+def write_frames(filename, frames, fmt):
+    """Writes a sequence of frames to a single file
+
+    Keyword arguments:
+    filename -- file to write, without extension
+    frames -- list of 2D arrays
+    fmt -- 'npz' for a compressed numpy stack or 'gif' for an animation
+    """
+    if (fmt == 'gif'):
+        frames = [numpy.clip(f, 0, 255).astype(numpy.uint8) for f in frames]
+        imageio.mimsave(filename + '.gif', frames)
+    else:
+        numpy.savez_compressed(filename + '.npz', frames=numpy.stack(frames))
+    return
+
+
+class Capture():
+    """Collects snapshot frames per plate and writes them in the background"""
+
+    def __init__(self, path, fmt='npz', max_pending=64, interval=100):
+        """Capture init
+
+        Keyword arguments:
+        path -- file name prefix, a plate index and extension are appended
+        fmt -- 'npz' or 'gif' (gif needs imageio)
+        max_pending -- number of frames that may wait for the writer before
+                       add blocks
+        interval -- number of flooded pixels between Tracer frames
+        """
+        if (fmt not in ('npz', 'gif')):
+            raise ValueError("unknown capture format '%s'" % fmt)
+        if (fmt == 'gif' and imageio is None):
+            raise ImportError('gif capture requires imageio')
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.plate_count = 0
+        self.error = None
+        self.queue = queue.Queue(max_pending)
+        self.thread = None
+        return
+
+    def begin(self):
+        """Starts a new plate and returns its index"""
+        if (self.thread is None):
+            self.thread = threading.Thread(target=self.writer, daemon=True)
+            self.thread.start()
+        index = self.plate_count
+        self.plate_count += 1
+        return index
+
+    def add(self, index, frame):
+        """Queues a frame for a plate, blocking while the queue is full
+
+        Keyword arguments:
+        index -- plate index returned by begin
+        frame -- 2D array, must not be modified afterwards
+        """
+        self.queue.put((index, frame))
+        return
+
+    def end(self, index):
+        """Marks a plate as complete so its frames get written
+
+        Keyword arguments:
+        index -- plate index returned by begin
+        """
+        self.queue.put((index, None))
+        return
+
+    def close(self):
+        """Waits for all pending writes and stops the writer thread"""
+        if (self.thread is not None):
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if (self.error is not None):
+            raise self.error
+        return
+
+    def writer(self):
+        """Writer thread loop, batches frames until their plate ends"""
+        pending = {}
+        while (True):
+            item = self.queue.get()
+            if (item is None):
+                break
+            index, frame = item
+            if (frame is not None):
+                pending.setdefault(index, []).append(frame)
+                continue
+            frames = pending.pop(index, [])
+            if (len(frames) == 0 or self.error is not None):
+                continue
+            try:
+                write_frames(self.path + str(index), frames, self.fmt)
+            except Exception as e:
+                self.error = e
+        return
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of trained SOM weights for warm starts.
+
+Plates from the same camera have nearly the same geometry, so a map trained
+on one plate is a good starting point for the next. Weights are kept as one
+.npy file per camera and image shape, loaded memory-mapped, and the least
+recently used files are removed once the cache holds more than max_entries.
+"""
+
+import collections
+import os
+import urllib.parse
+
+import numpy
+
+
+class WeightCache():
+    """Least recently used cache of (N, 2) neuron weight arrays on disk,
+       keyed by camera and image shape
+    """
+
+    def __init__(self, path, max_entries=64):
+        """WeightCache init, picks up the files already in path, most
+           recently used last
+
+        Keyword arguments:
+        path -- directory holding the .npy files, created if missing
+        max_entries -- number of weight arrays kept
+        """
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+
+        # file name -> None, least recently used first
+        self.entries = collections.OrderedDict()
+        names = [n for n in os.listdir(path) if (n.endswith('.npy'))]
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(path, n)))
+        for name in names:
+            self.entries[name] = None
+        self.evict()
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.filename(*key) in self.entries
+
+    def filename(self, camera, shape):
+        """Returns the file name of a camera and image shape
+
+        Keyword arguments:
+        camera -- camera id
+        shape -- (height, width) of the plates
+        """
+        return '%s_%dx%d.npy' % (urllib.parse.quote(str(camera), safe=''),
+                                 shape[0], shape[1])
+
+    def get(self, camera, shape):
+        """Returns the cached weights as a read only memory-mapped array, or
+           None when there are none
+
+        Keyword arguments:
+        camera -- camera id
+        shape -- (height, width) of the plates
+        """
+        name = self.filename(camera, shape)
+        if (name not in self.entries):
+            return None
+        filename = os.path.join(self.path, name)
+        try:
+            weights = numpy.load(filename, mmap_mode='r')
+        except (OSError, ValueError):
+            # removed or damaged behind our back
+            del self.entries[name]
+            return None
+        self.entries.move_to_end(name)
+        os.utime(filename)
+        return weights
+
+    def put(self, camera, shape, weights):
+        """Stores weights for a camera and image shape, replacing any that
+           were there
+
+        Keyword arguments:
+        camera -- camera id
+        shape -- (height, width) of the plates
+        weights -- (N, 2) array of neuron x, y positions
+        """
+        name = self.filename(camera, shape)
+        filename = os.path.join(self.path, name)
+
+        # write next to the target and swap it in, so readers never see a
+        # partial file
+        partial = filename + '.partial'
+        with open(partial, 'wb') as f:
+            numpy.save(f, numpy.asarray(weights, dtype=float).reshape(-1, 2))
+        os.replace(partial, filename)
+
+        self.entries[name] = None
+        self.entries.move_to_end(name)
+        self.evict()
+        return
+
+    def evict(self):
+        """Removes the least recently used files beyond max_entries"""
+        while (len(self.entries) > self.max_entries):
+            name, _ = self.entries.popitem(last=False)
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+        return
+
+
+def train(som, cache, camera, epochs):
+    """Trains a SOM whose neurons were already initialized. When the cache
+       has weights for the camera and image shape, they replace the initial
+       ones and only the last epochs of the schedule are run. The trained
+       weights are cached for the next plate. Returns what som.start
+       returns.
+
+    Keyword arguments:
+    som -- UnchainedSOM to train
+    cache -- WeightCache
+    camera -- camera id
+    epochs -- number of epochs of a warm started run
+    """
+    shape = numpy.shape(som.image)
+    weights = cache.get(camera, shape)
+    if (weights is not None):
+        som.warm_start(weights, epochs)
+    highlighted_image = som.start()
+    cache.put(camera, shape, som.weights)
+    return highlighted_image
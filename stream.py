@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming segmentation of consecutive video frames of the same plate.
+
+Only a band of rows around the pixels that changed since the previous frame
+is traced again. Accepted rects above and below the band are carried over
+from the previous frame. The band is grown until no cluster of either
+frame crosses its edges, and rects outside it share no rows with anything
+inside it, so they cannot cover each other. The result is the same as
+tracing every frame from scratch.
+"""
+
+import numpy
+
+import rectfinder
+
+
+class StreamSegmenter():
+    """Segments frames one at a time, reusing the previous frame's work"""
+
+    def __init__(self, area_min, area_max, max_mid_distance, engine='label'):
+        """StreamSegmenter init
+
+        Keyword arguments:
+        area_min -- the minimum area of a rect in percentage of image size (0-1)
+        area_max -- the maximum area of a rect in percentage of image size (0-1)
+        max_mid_distance -- the max dist rect can be from middle row of pixels
+                            in percentage of image size (0-1)
+        engine -- Tracer engine used for the rescans
+        """
+        self.segmenter = rectfinder.Segmenter(area_min, area_max, max_mid_distance, engine)
+        self.shape = None
+        self.frame_count = 0
+        self.rescanned_rows = 0     # rows traced again over all frames
+        return
+
+    def allocate(self, shape):
+        """Allocates the frame buffers for frames of this shape
+
+        Keyword arguments:
+        shape -- (height, width) of the frames
+        """
+        self.shape = shape
+        self.foreground = numpy.zeros(shape, dtype=bool)
+        self.previous = numpy.zeros(shape, dtype=bool)
+        self.changed = numpy.zeros(shape, dtype=bool)
+        self.bounds = None      # accepted rect records of the previous frame
+        height, width = shape
+        self.rects = rectfinder.RectStore(width, height)
+        return
+
+    def feed(self, frame):
+        """Segments the next frame and returns its accepted rects as a list
+
+        Keyword arguments:
+        frame -- the preprocessed frame to analyze
+        """
+        frame = numpy.asarray(frame)
+        if (self.shape != frame.shape):
+            self.allocate(frame.shape)
+        height, width = frame.shape
+        self.frame_count += 1
+
+        # swap buffers, the old foreground becomes the previous one
+        self.foreground, self.previous = self.previous, self.foreground
+        numpy.not_equal(frame, 0, out=self.foreground)
+
+        if (self.bounds is None):
+            band = (10, height - 10)
+        else:
+            numpy.not_equal(self.foreground, self.previous, out=self.changed)
+            rows = numpy.flatnonzero(self.changed[10:height-10, 10:width-10].any(axis=1))
+            if (len(rows) == 0):
+                # nothing changed, the previous rects still hold
+                return list(self.rects)
+            band = self.grow_band(rows[0] + 10, rows[-1] + 11)
+
+        # trace the band, then merge with the rects outside it by seed
+        # position, which is the order the full scan accepts them in
+        found = self.segmenter.run(frame, band).view
+        self.rescanned_rows += band[1] - band[0]
+        if (self.bounds is not None):
+            outside = (self.bounds['bottom'] < band[0]) | (self.bounds['top'] >= band[1])
+            found = numpy.concatenate([self.bounds[outside], found])
+        found = found[numpy.argsort(found['seed'], kind='stable')]
+
+        self.rects.clear()
+        for top, bottom, left, right, seed in found.tolist():
+            self.rects.append(rectfinder.Rect(top, bottom, left, right), seed)
+            self.rects.accept(self.rects.pending)
+        self.bounds = self.rects.view.copy()
+        return list(self.rects)
+
+    def grow_band(self, top, bottom):
+        """Returns a (top, bottom) band of rows holding rows top to bottom-1
+           that no cluster of the new or the previous frame and no rect of
+           the previous frame crosses.
+
+        Keyword arguments:
+        top -- first changed row
+        bottom -- one past the last changed row
+        """
+        height = self.shape[0]
+        fg = self.foreground[:, 10:self.shape[1]-10]
+        old = self.previous[:, 10:self.shape[1]-10]
+        step = 1
+        while (True):
+            grown = False
+
+            # previous rects that reach into the band are traced again
+            # whole
+            b = self.bounds
+            inside = (b['bottom'] >= top) & (b['top'] < bottom)
+            if (inside.any()):
+                new_top = min(top, int(b['top'][inside].min()))
+                new_bottom = max(bottom, int(b['bottom'][inside].max()) + 1)
+                grown = new_top != top or new_bottom != bottom
+                top, bottom = new_top, new_bottom
+
+            # clusters of either frame crossing an edge, a rejected cluster
+            # of the previous frame may have been split by the change
+            if (top > 10 and ((fg[top - 1] & fg[top]) | (old[top - 1] & old[top])).any()):
+                top = max(10, top - step)
+                grown = True
+            if (bottom < height - 10 and
+                ((fg[bottom - 1] & fg[bottom]) | (old[bottom - 1] & old[bottom])).any()):
+                bottom = min(height - 10, bottom + step)
+                grown = True
+
+            if (not grown):
+                return top, bottom
+            step *= 2
+
+    def stream(self, frames):
+        """Generator yielding the accepted rects of each frame
+
+        Keyword arguments:
+        frames -- iterable of preprocessed frames
+        """
+        for frame in frames:
+            yield self.feed(frame)
+        return
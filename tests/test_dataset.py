@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that dataset.sweep returns the same rects as a fresh Tracer for
+every plate and setting.
+"""
+
+import numpy
+
+import dataset
+import rectfinder
+
+
+SETTINGS = [(0.0005, 0.2, 0.6), (0.01, 0.2, 0.6), (0.0005, 0.01, 0.2)]
+
+
+def make_plates(n, seed=5):
+    """Returns n synthetic plates of seven hollow characters with noise,
+       with the 10 pixel border cleared like the preprocessor does
+
+    Keyword arguments:
+    n -- number of plates
+    seed -- random seed
+    """
+    rng = numpy.random.default_rng(seed)
+    plates = []
+    for i in range(n):
+        img = numpy.zeros((80, 260), dtype=numpy.uint8)
+        for k in range(7):
+            x = 20 + k * 32
+            img[25:55, x:x + 20] = 255
+            img[30:50, x + 4:x + 16] = 0
+        img[rng.random(img.shape) < 0.03] = 255
+        img[:11] = 0
+        img[:, :11] = 0
+        img[-10:] = 0
+        img[:, -10:] = 0
+        plates.append(img)
+    return plates
+
+
+def table_rects(arrays, plate, setting):
+    """Returns the (top, bottom, left, right) rects of one plate and setting"""
+    rows = (arrays['plate'] == plate) & (arrays['setting'] == setting)
+    return list(zip(*(arrays[name][rows].tolist()
+                      for name in ('top', 'bottom', 'left', 'right'))))
+
+
+def fresh_rects(plate, setting):
+    """Returns the rects a new Tracer finds with one setting"""
+    tracer = rectfinder.Tracer(plate, *setting, engine='label')
+    return [(r.top, r.bottom, r.left, r.right) for r in tracer.rects]
+
+
+def check_sweep(plates, table):
+    arrays = table.arrays()
+    for index, plate in enumerate(plates):
+        for k, setting in enumerate(SETTINGS):
+            assert table_rects(arrays, index, k) == fresh_rects(plate, setting), (index, k)
+
+
+def test_sweep_matches_fresh_tracers():
+    plates = make_plates(4)
+    check_sweep(plates, dataset.sweep(plates, SETTINGS))
+
+
+def test_sweep_raw_stack(tmp_path):
+    plates = make_plates(3)
+    path = str(tmp_path / 'plates.raw')
+    dataset.write_stack(path, plates)
+    stack = dataset.PlateStack(path)
+    assert len(stack) == 3
+    check_sweep(plates, dataset.sweep(stack, SETTINGS))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Parity of the kernels with the python code of Tracer and UnchainedSOM.
+
+The kernels are checked as plain python on every machine, and compiled
+when numba is installed.
+"""
+
+import numpy
+import pytest
+
+import alpr_som
+import kernels
+import rectfinder
+
+
+def python(kernel):
+    """Returns the python function of a kernel, compiled or not"""
+    return getattr(kernel, 'py_func', kernel)
+
+
+BACKENDS = [
+    pytest.param(python, id='python'),
+    pytest.param(lambda kernel: kernel, id='numba',
+                 marks=pytest.mark.skipif(kernels.numba is None, reason='numba is not installed')),
+]
+
+
+def random_images(n, seed=1):
+    """Returns n random binary images of random size and density"""
+    rng = numpy.random.default_rng(seed)
+    images = []
+    for i in range(n):
+        height = int(rng.integers(25, 80))
+        width = int(rng.integers(25, 120))
+        density = rng.uniform(0.3, 0.7)
+        images.append((rng.random((height, width)) < density).astype(numpy.uint8) * 255)
+    return images
+
+
+@pytest.mark.parametrize('compile', BACKENDS)
+def test_flood_matches_trace(compile):
+    flood = compile(kernels.flood)
+    rng = numpy.random.default_rng(2)
+    abandoned_clusters = 0
+    for image in random_images(40):
+        area_max = rng.choice([0.02, 0.2, 1.0])
+        tracer = rectfinder.Tracer(image, 0.0005, area_max, 0.6, engine='flood',
+                                   backend='python')
+        height, width = image.shape
+        stack = numpy.empty(height * width, dtype=numpy.int64)
+        ys, xs = numpy.nonzero(image[10:height-10, 10:width-10])
+        for k in rng.choice(len(xs), min(len(xs), 20), replace=False):
+            x = int(xs[k]) + 10
+            y = int(ys[k]) + 10
+
+            tracer.visited[...] = 0
+            r = rectfinder.Rect(y, y, x, x)
+            tracer.trace(r, x, y)
+
+            visited = numpy.zeros_like(tracer.visited)
+            top, bottom, left, right, flooded, depth, abandoned = flood(
+                image, visited, stack, x, y, tracer.max_size)
+
+            # both flood in a different order, so a cluster that is too
+            # large may be abandoned by one of them only, or at other bounds.
+            # It is still visited completely, its zero neighbours only when
+            # not abandoned.
+            abandoned_clusters += abandoned
+            foreground = image != 0
+            assert numpy.array_equal(visited[foreground], tracer.visited[foreground])
+            area = (bottom - top + 1) * (right - left + 1)
+            if (area > tracer.max_size or r.area > tracer.max_size):
+                assert area > tracer.max_size and r.area > tracer.max_size
+            else:
+                assert numpy.array_equal(visited, tracer.visited)
+                assert (top, bottom, left, right) == (r.top, r.bottom, r.left, r.right)
+    assert abandoned_clusters > 0
+
+
+def test_tracer_backends_match(monkeypatch):
+    # the numba path of Tracer, with the kernel run as python
+    monkeypatch.setattr(kernels, 'flood', python(kernels.flood))
+    for image in random_images(20, seed=3):
+        for area_max in (0.02, 0.2):
+            reference = rectfinder.Tracer(image, 0.0005, area_max, 0.6, engine='flood',
+                                          backend='python')
+            tracer = rectfinder.Tracer(None, 0.0005, area_max, 0.6, engine='flood',
+                                       backend='python')
+            tracer.backend = 'numba'
+            tracer.run(image)
+            assert tracer.rects.view.tolist() == reference.rects.view.tolist()
+
+
+@pytest.mark.parametrize('compile', BACKENDS)
+def test_som_epoch_matches_python(compile):
+    som_epoch = compile(kernels.som_epoch)
+    image = random_images(1, seed=4)[0]
+    som = alpr_som.UnchainedSOM(image, 0.5, 1000, 1, 300, 301, 2, 3, rng=5,
+                                backend='python')
+    som.init_neurons_grid(6, 3)
+    for time in range(1, 300):
+        weights = som.weights.copy()
+        neighborhood = numpy.zeros(len(weights))
+        win_count = som.win_count.copy()
+        win_cycle = som.win_cycle.copy()
+        cycle = som.cycle
+
+        xs, ys = som.sample_pixels(1)
+        x = xs[0]
+        y = ys[0]
+        winner = som.find_winner(x, y)
+        som.calculate_neighborhood(x, y, winner, time)
+        som.adjust_weights(x, y, time)
+
+        learning_rate = som.nu_not / numpy.exp(time / som.tau_nu)
+        found = som_epoch(weights, neighborhood, win_count, win_cycle, cycle, som.win_limit,
+                          x, y, time, learning_rate)
+        assert found == winner
+        assert numpy.allclose(neighborhood, som.neighborhood, rtol=1e-9, atol=1e-9)
+        assert numpy.allclose(weights, som.weights, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Parity of the label engine and its coarse pass, region of interest and
+strip labeling with the flood engine: the same accepted rects in the same
+order.
+"""
+
+import numpy
+import pytest
+
+import benchmark
+import rectfinder
+
+
+def bounds(tracer):
+    return tracer.rects.view[['top', 'bottom', 'left', 'right']].tolist()
+
+
+def cases(seed, n, height=(25, 80), width=(25, 120)):
+    """Returns n (image, area_min, area_max, max_mid_distance) cases, noise
+       of random density and synthetic plates
+
+    Keyword arguments:
+    seed -- random seed
+    n -- number of cases
+    height -- range of image heights
+    width -- range of image widths
+    """
+    rng = numpy.random.default_rng(seed)
+    found = []
+    for i in range(n):
+        h = int(rng.integers(*height))
+        w = int(rng.integers(*width))
+        if (i % 3 == 2):
+            image = benchmark.synthetic_plate(h, w, 7, rng.uniform(0, 0.05), rng)
+            settings = (0.0005, 0.2, rng.uniform(0.2, 1))
+        else:
+            image = (rng.random((h, w)) < rng.uniform(0.2, 0.7)).astype(numpy.uint8) * 255
+            settings = (rng.uniform(0, 0.01), rng.uniform(0.01, 0.5), rng.uniform(0.1, 1))
+        found.append((image,) + settings)
+    return found
+
+
+SMALL = cases(9, 60)
+TALL = cases(10, 6, height=(150, 260), width=(40, 100))
+
+
+@pytest.mark.parametrize('options', [{}, {'coarse': 2}, {'coarse': 4}, {'coarse': 8}],
+                         ids=['label', 'coarse2', 'coarse4', 'coarse8'])
+def test_label_matches_flood(options):
+    for image, area_min, area_max, max_mid_distance in SMALL + TALL:
+        reference = rectfinder.Tracer(image, area_min, area_max, max_mid_distance,
+                                      engine='flood')
+        tracer = rectfinder.Tracer(image, area_min, area_max, max_mid_distance,
+                                   engine='label', **options)
+        assert bounds(tracer) == bounds(reference)
+
+
+@pytest.mark.parametrize('threads', [2, 3, 4])
+def test_strips_match_single_thread(threads):
+    for image, area_min, area_max, max_mid_distance in TALL:
+        # enough interior rows for at least two strips
+        assert len(image) - 21 >= 128
+        reference = rectfinder.Tracer(image, area_min, area_max, max_mid_distance,
+                                      engine='flood')
+        tracer = rectfinder.Tracer(image, area_min, area_max, max_mid_distance,
+                                   engine='label', threads=threads)
+        assert tracer.executor is not None
+        assert bounds(tracer) == bounds(reference)
+        tracer.executor.shutdown()
+
+
+@pytest.mark.parametrize('engine', ['flood', 'label'])
+def test_roi_matches_unpruned(engine, monkeypatch):
+    rng = numpy.random.default_rng(11)
+    for image, area_min, area_max, max_mid_distance in SMALL + TALL:
+        height = len(image)
+        first = int(rng.integers(0, height))
+        roi = (first, int(rng.integers(first, height)))
+        tracer = rectfinder.Tracer(image, area_min, area_max, max_mid_distance,
+                                   engine=engine, roi=roi)
+
+        # the reject rule alone, every row scanned
+        with monkeypatch.context() as m:
+            m.setattr(rectfinder, 'coarse_band', lambda image, *args: (10, len(image) - 10))
+            reference = rectfinder.Tracer(image, area_min, area_max, max_mid_distance,
+                                          engine='flood', roi=roi)
+        assert bounds(tracer) == bounds(reference)
+        for top, bottom, left, right in bounds(tracer):
+            assert top <= roi[1] and bottom >= roi[0]
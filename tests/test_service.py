@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that closing a SegmentationService answers every request, also the
+ones of producers held up by a full queue.
+"""
+
+import asyncio
+
+import numpy
+import pytest
+
+import benchmark
+import service
+
+
+def plates(n, seed=3):
+    rng = numpy.random.default_rng(seed)
+    return [benchmark.synthetic_plate(60, 200, 7, 0.02, rng) for i in range(n)]
+
+
+async def close_while_full():
+    segmenter = service.SegmentationService(0.0005, 0.2, 0.6, workers=1, max_queue=2,
+                                            max_batch=2)
+    await segmenter.start()
+    tasks = [asyncio.ensure_future(segmenter.segment(plate)) for plate in plates(10)]
+    # let the producers fill the queue and block on it
+    for i in range(5):
+        await asyncio.sleep(0)
+    await segmenter.close()
+    results = await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), 5)
+    return segmenter, results
+
+
+def test_close_answers_blocked_producers():
+    segmenter, results = asyncio.run(close_while_full())
+    assert len(results) == 10
+    for result in results:
+        if (isinstance(result, BaseException)):
+            assert isinstance(result, RuntimeError), result
+        else:
+            assert isinstance(result, list)
+    assert any(isinstance(result, RuntimeError) for result in results)
+    assert segmenter.queue.qsize() == 0
+
+
+async def segment_after_close():
+    segmenter = service.SegmentationService(0.0005, 0.2, 0.6, workers=1)
+    await segmenter.start()
+    await segmenter.close()
+    await segmenter.segment(plates(1)[0])
+
+
+def test_segment_after_close():
+    with pytest.raises(RuntimeError):
+        asyncio.run(segment_after_close())
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the competition cycle bookkeeping of UnchainedSOM when the wins are
+set through the SOMNeuron views.
+"""
+
+import numpy
+
+import alpr_som
+
+
+def make_som(batch_size=1):
+    rng = numpy.random.default_rng(6)
+    image = (rng.random((40, 80)) < 0.5).astype(numpy.uint8) * 255
+    som = alpr_som.UnchainedSOM(image, 0.5, 1000, 1, 200, 201, 2, 3, batch_size=batch_size,
+                                rng=7, backend='python')
+    som.init_neurons_grid(3, 2)
+    return som
+
+
+def reset_wins(som):
+    for n in som.neurons:
+        n.wins = 0
+
+
+def test_reset_through_views_keeps_cycling():
+    som = make_som()
+    for time in range(1, 4):
+        som.epoch(time)
+    reset_wins(som)
+    assert som.outstanding == len(som.weights)
+
+    winners = []
+    for i in range(3 * len(som.weights)):
+        xs, ys = som.sample_pixels(1)
+        winners.append(som.find_winner(xs[0], ys[0]))
+    # with a win limit of 1 every neuron wins once per cycle
+    assert som.cycle == 4
+    for k in range(0, len(winners), len(som.weights)):
+        assert sorted(winners[k:k + len(som.weights)]) == list(range(len(som.weights)))
+
+
+def test_reset_through_views_with_batches():
+    som = make_som(batch_size=4)
+    som.epoch_batch(1, 4)
+    reset_wins(som)
+    for time in range(5, 100, 4):
+        som.epoch_batch(time, 4)
+        assert som.eligible().any()
+
+
+def test_set_wins_counts_outstanding():
+    som = make_som()
+    som.neurons[0].wins = 1
+    som.neurons[1].wins = 2
+    assert som.outstanding == len(som.weights) - 2
+    som.neurons[1].wins = 0
+    assert som.outstanding == len(som.weights) - 1
+    assert som.wins.tolist() == [1] + [0] * (len(som.weights) - 1)
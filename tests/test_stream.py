@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that StreamSegmenter returns the rects of a fresh Tracer on every
+frame.
+"""
+
+import numpy
+import pytest
+
+import rectfinder
+import stream
+
+
+def bounds(rects):
+    return [(r.top, r.bottom, r.left, r.right) for r in rects]
+
+
+def fresh(frame, settings, engine):
+    return bounds(rectfinder.Tracer(frame, *settings, engine=engine).rects)
+
+
+@pytest.mark.parametrize('engine', ['flood', 'label'])
+def test_split_rejected_cluster(engine):
+    # a bar too large to accept, cut in two by the second frame
+    settings = (0.0005, 0.02, 1.0)
+    first = numpy.zeros((100, 200), dtype=numpy.uint8)
+    first[20:81, 50:61] = 255
+    second = first.copy()
+    second[50, 50:61] = 0
+
+    segmenter = stream.StreamSegmenter(*settings, engine=engine)
+    for frame in (first, second):
+        assert bounds(segmenter.feed(frame)) == fresh(frame, settings, engine)
+    assert fresh(second, settings, engine) == [(20, 49, 50, 60), (51, 80, 50, 60)]
+
+
+@pytest.mark.parametrize('engine', ['flood', 'label'])
+def test_random_changes(engine):
+    rng = numpy.random.default_rng(8)
+    for sequence in range(10):
+        settings = (rng.uniform(0, 0.005), rng.uniform(0.01, 0.2), rng.uniform(0.2, 1))
+        frame = numpy.zeros((int(rng.integers(40, 100)), int(rng.integers(60, 160))),
+                            dtype=numpy.uint8)
+        frame[rng.random(frame.shape) < 0.3] = 255
+        segmenter = stream.StreamSegmenter(*settings, engine=engine)
+        for k in range(8):
+            # draw or cut a bar, or add noise, somewhere in the frame
+            frame = frame.copy()
+            height, width = frame.shape
+            y = int(rng.integers(0, height - 5))
+            x = int(rng.integers(0, width - 5))
+            change = rng.integers(3)
+            if (change == 0):
+                frame[y:y + int(rng.integers(5, height)), x:x + 4] = 255
+            elif (change == 1):
+                frame[y, x:x + int(rng.integers(5, width))] = 0
+            else:
+                patch = frame[y:y + 5, x:x + 5]
+                patch[rng.random(patch.shape) < 0.5] ^= 255
+            assert bounds(segmenter.feed(frame)) == fresh(frame, settings, engine), (sequence, k)